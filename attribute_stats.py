@@ -0,0 +1,90 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from trace_store import load_metadata, store_file_names
+
+# all list-valued metadata columns of a family
+ATTRIBUTES = ['Animal_Model', 'Brain_Area', 'Neuron_Region', 'Neuron_Type', \
+                'Runtime_Q', 'Subtype', 'Age', 'Author', 'Temperature']
+
+
+
+class AttributeStatistics():
+    """
+    Definition
+        Value statistics over the list-valued metadata columns of a family.
+        Each attribute column is exploded once (one row per value, indexed by
+        the row of the channel), counted vectorized, and the results are
+        cached per attribute, so switching attributes in a viewer only costs
+        a dictionary lookup after the first time.
+
+    Args:
+        meta_df (pd.DataFrame): metadata of the family, e.g. load_metadata()
+    """
+
+    def __init__(self, meta_df):
+        self.meta_df = meta_df.reset_index(drop=True)
+        self._exploded = {}
+        self._counts = {}
+        self._rows = {}
+
+    def exploded(self, attribute):
+        """
+        Returns a series with one entry per (channel row, value) pair, the
+        index being the row of the channel.
+        """
+        if (attribute not in self._exploded):
+            values = self.meta_df[attribute].explode().dropna()
+            self._exploded[attribute] = values.astype(str)
+        return self._exploded[attribute]
+
+    def value_counts(self, attribute):
+        """
+        Returns the number of channels per value of an attribute (unsorted).
+        """
+        if (attribute not in self._counts):
+            self._counts[attribute] = self.exploded(attribute) \
+                                        .value_counts(sort=False)
+        return self._counts[attribute]
+
+    def top_values(self, attribute, k=30):
+        """
+        Returns the k most common values of an attribute as a list of
+        (value, count) tuples, most common first. Only a partial sort of the
+        counts is done.
+        """
+        counts = self.value_counts(attribute).nlargest(k, keep="first")
+        return list(zip(counts.index, counts.tolist()))
+
+    def rows_per_value(self, attribute):
+        """
+        Returns a dictionary value:sorted array of the rows having this value.
+        """
+        if (attribute not in self._rows):
+            values = self.exploded(attribute)
+            grouped = pd.Series(values.index.to_numpy(), index=values.to_numpy())
+            self._rows[attribute] = {value: np.unique(rows.to_numpy()) \
+                                        for value, rows in \
+                                        grouped.groupby(level=0, sort=False)}
+        return self._rows[attribute]
+
+
+
+@lru_cache(maxsize=8)
+def _attribute_statistics(meta_name, mtime):
+    return AttributeStatistics(load_metadata(meta_name))
+
+
+
+def attribute_statistics(meta_name):
+    """
+    Returns the AttributeStatistics of a trace store, one shared instance
+    per store, so its per attribute cache survives across calls (e.g. a
+    viewer switching attributes). A store dumped again (newer sidecar) gets
+    a new instance.
+    """
+    _, sidecar_name = store_file_names(meta_name)
+    return _attribute_statistics(meta_name, os.path.getmtime(sidecar_name))
@@ -0,0 +1,79 @@
+"""
+Benchmark of the family dataframe assembly: the former row by row growth of
+the dataframe against assemble_family_frame, for synthetic families of
+growing size (up to 10k channels).
+
+Usage:
+    python benchmarks/bench_assembly.py [--max-legacy 5000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_extraction_processing import assemble_family_frame, METADATA_COLUMNS
+
+
+
+def synthetic_fetched(n_channels, n_trace_values=2000, seed=0):
+    """
+    Creates id list and an id -> (metadata, trace) dictionary shaped like the
+    output of the harvester.
+    """
+    rng = np.random.RandomState(seed)
+    id_list = list(range(1000, 1000 + n_channels))
+    fetched = {}
+    for _id in id_list:
+        meta = [["Rat"], ["Hippocampus", "Cortex"], [], ["Pyramidal"], [],
+                ["Kv1.1"], ["Adult"], ["Author " + str(_id % 50)], ["22"]]
+        fetched[_id] = (meta, rng.randn(n_trace_values).tolist())
+    return id_list, fetched
+
+
+
+def legacy_assembly(id_list, family_name, fetched):
+    """
+    Replica of the former assembly in dump_family_as_json_with_trace.
+    """
+    channel_df = pd.DataFrame()
+    channel_df['ID'] = id_list
+    channel_df['Family'] = [family_name for i in range(len(id_list))]
+    meta_df = pd.DataFrame(columns=METADATA_COLUMNS)
+    for _id in id_list:
+        meta_df.loc[len(meta_df)] = fetched[_id][0]
+    for _id in id_list:
+        channel_df.loc[channel_df['ID']==_id, 'Conc_Trace'] =            \
+            pd.Series([fetched[_id][1]],                                 \
+            index = [channel_df.loc[channel_df['ID']==_id].index[0]])
+    return pd.concat([channel_df, meta_df], axis=1)
+
+
+
+def time_it(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[500, 1000, 2000, 5000, 10000])
+    parser.add_argument("--n-trace-values", type=int, default=2000)
+    parser.add_argument("--max-legacy", type=int, default=5000,
+                        help="skip the quadratic legacy version above this")
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12}".format("channels", "legacy [s]", "columnar [s]"))
+    for n_channels in args.sizes:
+        id_list, fetched = synthetic_fetched(n_channels, args.n_trace_values)
+        legacy = float("nan")
+        if (n_channels <= args.max_legacy):
+            legacy = time_it(legacy_assembly, id_list, "K", fetched)
+        columnar = time_it(assemble_family_frame, id_list, "K", fetched)
+        print("{:>8} {:>12.3f} {:>12.3f}".format(n_channels, legacy, columnar))
@@ -0,0 +1,50 @@
+"""
+Seeded comparison of the embedding backends on a family dump: wall time and
+trustworthiness (how well local neighbourhoods are preserved) of each
+installed backend.
+
+Usage:
+    python benchmarks/bench_embedding.py Na_family [--pca-dim 21] [--n-jobs -1]
+"""
+import argparse
+import os
+import sys
+import time
+
+from sklearn.manifold import trustworthiness
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from trace_store import TraceStore
+from preprocessing import normalized_trace_matrix, pca_reduce
+from embedding import embed, available_backends
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_prefix", help="trace store, e.g. Na_family")
+    parser.add_argument("--backends", nargs="+", default=None)
+    parser.add_argument("--pca-dim", type=int, default=None)
+    parser.add_argument("--perplexity", type=float, default=30)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-neighbors", type=int, default=10,
+                        help="neighbourhood size of the trustworthiness")
+    args = parser.parse_args()
+
+    data_array = normalized_trace_matrix(TraceStore(args.store_prefix))
+    if (args.pca_dim is not None):
+        data_array, _ = pca_reduce(data_array, args.pca_dim)
+
+    backends = args.backends or available_backends()
+    print("{:>10} {:>10} {:>16}".format("backend", "time [s]",
+                                        "trustworthiness"))
+    for backend in backends:
+        start = time.perf_counter()
+        data2d = embed(data_array, backend=backend,
+                        perplexity=args.perplexity, n_jobs=args.n_jobs,
+                        seed=args.seed)
+        wall_time = time.perf_counter() - start
+        trust = trustworthiness(data_array, data2d,
+                                n_neighbors=args.n_neighbors)
+        print("{:>10} {:>10.2f} {:>16.4f}".format(backend, wall_time, trust))
@@ -0,0 +1,317 @@
+"""
+Synthetic stand-in for the ICG api: a seeded generator of channels (family
+listing, metadata and traces in the json schemas the getters parse) and a
+local http server serving them with configurable latency and error rate.
+
+Usage (serve a synthetic family for e.g. dump_family_as_json_with_trace):
+    python benchmarks/icg_fixture.py --channels 10000 --latency 0.05
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_extraction_processing import TRACE_NAMES, parse_metadata
+
+# values of the metadata categories, the first ones being the most common
+VOCABULARY = {"Animal Model": ["Rat", "Mouse", "Human", "Guinea pig", "Cat",
+                                "Xenopus"],
+                "Brain Area": ["Hippocampus", "Cortex", "Cerebellum",
+                                "Thalamus", "Spinal cord", "Brainstem",
+                                "Striatum", "Retina"],
+                "Neuron Region": ["Soma", "Dendrite", "Axon", "AIS"],
+                "Neuron Type": ["Pyramidal", "Purkinje", "Interneuron",
+                                "Granule", "Motoneuron", "Stellate"],
+                "Runtime Q": ["Q1", "Q2", "Q3"],
+                "Subtype": ["Kv1.1", "Kv2.1", "Kv3.1", "Kv4.2", "Nav1.1",
+                            "Nav1.6", "Cav2.1", "Cav3.1", "HCN1", "SK2"],
+                "Age": ["Adult", "Juvenile", "Neonatal"],
+                "Authors": ["Author {}".format(i) for i in range(200)],
+                "Temperature": [str(t) for t in range(20, 38)]}
+
+# categories delivered as "metadata" name/value pairs instead of "cls" lists
+VALUE_CATEGORIES = ["Age", "Temperature"]
+
+
+
+class SyntheticICG():
+    """
+    Definition
+        Deterministic synthetic channels: every channel belongs to one of
+        n_kinetic_classes (activation midpoint, slope, time constant, ...),
+        its traces are the curves of its class with jittered parameters plus
+        noise, so embedding and clustering find structure like on real
+        families. Everything is derived from (seed, channel id), so any
+        channel can be generated on its own, in any process.
+
+    Args:
+        n_channels (int): channels of the family
+        n_values (int or dict): values per protocol trace, or a dictionary
+                                protocol:values
+        seed (int): seed of the fixture
+        first_id (int): id of the first channel
+        n_kinetic_classes (int): number of underlying channel types
+    """
+
+    def __init__(self, n_channels=1000, n_values=200, seed=0, first_id=1000,
+                    n_kinetic_classes=8):
+        self.n_channels = n_channels
+        if (not isinstance(n_values, dict)):
+            n_values = {name: n_values for name in TRACE_NAMES}
+        self.n_values = n_values
+        self.seed = seed
+        self.first_id = first_id
+        self.n_kinetic_classes = n_kinetic_classes
+
+        rng = np.random.RandomState(seed)
+        # columns: half activation, slope, half inactivation, tau, spike time
+        self.class_params = np.column_stack([rng.uniform(-60, 0,
+                                                        n_kinetic_classes),
+                                            rng.uniform(3, 12,
+                                                        n_kinetic_classes),
+                                            rng.uniform(-90, -30,
+                                                        n_kinetic_classes),
+                                            rng.uniform(0.05, 0.5,
+                                                        n_kinetic_classes),
+                                            rng.uniform(0.2, 0.6,
+                                                        n_kinetic_classes)])
+
+    @property
+    def ids(self):
+        return list(range(self.first_id, self.first_id + self.n_channels))
+
+    def trace_block(self, ids):
+        """
+        Returns a dictionary protocol:(len(ids) x values) array of the traces
+        of the given channels, generated vectorized.
+        """
+        ids = np.asarray(ids)
+        n_total = sum(self.n_values.values())
+        # per channel random streams, so a channel looks the same whether it
+        # is generated alone (http) or in a block
+        jitter = np.empty((len(ids), self.class_params.shape[1]))
+        noise = np.empty((len(ids), n_total))
+        for row, _id in enumerate(ids.tolist()):
+            rng = np.random.default_rng([self.seed, _id])
+            jitter[row] = rng.normal(1., 0.05, jitter.shape[1])
+            noise[row] = rng.standard_normal(n_total)
+
+        params = self.class_params[ids % self.n_kinetic_classes] * jitter
+        v_act, slope, v_inact, tau, t_spike = [column[:, np.newaxis] for \
+                                                column in params.T]
+
+        traces = {}
+        start = 0
+        for name, n_values in self.n_values.items():
+            voltage = np.linspace(-100., 60., n_values)
+            time_axis = np.linspace(0., 1., n_values)
+            if (name == "Activation"):
+                trace = 1. / (1. + np.exp(-(voltage - v_act) / slope))
+            elif (name == "Inactivation"):
+                trace = 1. / (1. + np.exp((voltage - v_inact) / slope))
+            elif (name == "Deactivation"):
+                trace = np.exp(-time_axis / tau)
+            elif (name == "Ramp"):
+                trace = 1. / (1. + np.exp(-(voltage - v_act) / slope)) / \
+                        (1. + np.exp((voltage - v_inact - 40.) / slope))
+            else:
+                trace = -70. + 100.*np.exp(-((time_axis - t_spike) / \
+                                            (0.02 + 0.1*tau))**2)
+            scale = 0.01*np.abs(trace).max(axis=1, keepdims=True) + 1e-3
+            traces[name] = trace + scale*noise[:, start:start + n_values]
+            start += n_values
+        return traces
+
+    def metadata_values(self, channel_id):
+        """
+        Returns a dictionary category:list of values of a channel, common
+        values being drawn more often (zipf like).
+        """
+        rng = random.Random(self.seed * 1000003 + channel_id)
+        values = {}
+        for category, vocabulary in VOCABULARY.items():
+            weights = [1. / (rank + 1) for rank in range(len(vocabulary))]
+            n_values = 1 if category in VALUE_CATEGORIES else \
+                        rng.choice([1, 1, 1, 2])
+            values[category] = sorted(set(rng.choices(vocabulary, weights,
+                                                        k=n_values)))
+        return values
+
+    def family_json(self):
+        return {"count": self.n_channels,
+                "chans": [{"id": _id} for _id in self.ids]}
+
+    def trace_json(self, channel_id):
+        traces = self.trace_block([channel_id])
+        return {"traces": [{"traces": {name: {"data": [trace[0].tolist()]} \
+                                        for name, trace in traces.items()}}]}
+
+    def metadata_json(self, channel_id):
+        values = self.metadata_values(channel_id)
+        return {"cls": [{"name": category, "cls": [{"name": value} for \
+                                                    value in values[category]]}
+                        for category in VOCABULARY if \
+                        category not in VALUE_CATEGORIES],
+                "metadata": [{"name": category, "value": values[category][0]}
+                                for category in VALUE_CATEGORIES]}
+
+    def fetched(self, chunk_size=4096):
+        """
+        Returns id list and id -> (metadata, trace dictionary) as produced by
+        the harvester, without going through http (trace rows are views
+        into generated blocks, so 50k channels fit in memory).
+        """
+        ids = self.ids
+        fetched = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            block = self.trace_block(chunk)
+            for row, _id in enumerate(chunk):
+                meta = parse_metadata(self.metadata_json(_id))
+                fetched[_id] = (meta, {name: block[name][row] for name in \
+                                        self.n_values})
+        return ids, fetched
+
+
+
+def make_handler(fixture, latency=0., jitter=0., error_rate=0., seed=0):
+    """
+    Returns a request handler class serving the fixture under the paths of
+    the ICG api ("/api/app/families/<id>/", "/api/app/chs/<id>[/traces]").
+    """
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    class ICGHandler(BaseHTTPRequestHandler):
+        # keep-alive, so pooled sessions reuse their connections, and no
+        # nagle delay between header and body of a response
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, status, body=b"", headers=()):
+            self.send_response(status)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with rng_lock:
+                delay = latency + rng.uniform(0., jitter)
+                fail = rng.random() < error_rate
+            if (delay > 0):
+                time.sleep(delay)
+            if (fail):
+                return self.send_body(503, headers=[("Retry-After", "0")])
+
+            parts = [part for part in self.path.split("/") if part]
+            try:
+                if ("families" in parts):
+                    data = fixture.family_json()
+                elif (parts[-1] == "traces"):
+                    data = fixture.trace_json(int(parts[-2]))
+                else:
+                    data = fixture.metadata_json(int(parts[-1]))
+            except (ValueError, IndexError):
+                return self.send_body(404)
+
+            body = json.dumps(data).encode("utf8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if (self.headers.get("If-None-Match") == etag):
+                return self.send_body(304, headers=[("ETag", etag)])
+            self.send_body(200, body, [("Content-Type", "application/json"),
+                                        ("ETag", etag)])
+
+    return ICGHandler
+
+
+
+def serve(fixture, port=0, latency=0., jitter=0., error_rate=0.,
+            port_queue=None):
+    server = ThreadingHTTPServer(("127.0.0.1", port),
+                                    make_handler(fixture, latency, jitter,
+                                                    error_rate, fixture.seed))
+    server.daemon_threads = True
+    if (port_queue is not None):
+        port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+
+class MockICGServer():
+    """
+    Definition
+        Serves a SyntheticICG in a separate process (so the server does not
+        compete with the benchmarked client for the GIL). Use as a context
+        manager; base_url can be passed to the getters, the harvester or
+        dump_family_as_json_with_trace.
+
+    Args:
+        fixture (SyntheticICG): channels to serve
+        latency (float): seconds every response is delayed
+        jitter (float): additional uniformly distributed delay
+        error_rate (float): fraction of requests answered with a 503
+    """
+
+    def __init__(self, fixture, latency=0., jitter=0., error_rate=0.):
+        self.fixture = fixture
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.process = None
+        self.base_url = None
+
+    def start(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve,
+                            args=(self.fixture, 0, self.latency, self.jitter,
+                                    self.error_rate, port_queue), daemon=True)
+        self.process.start()
+        self.base_url = "http://127.0.0.1:{}/api/app/".format(
+                            port_queue.get(timeout=30))
+        return self.base_url
+
+    def stop(self):
+        if (self.process is not None):
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--values", type=int, default=200,
+                        help="values per protocol trace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.)
+    parser.add_argument("--jitter", type=float, default=0.)
+    parser.add_argument("--error-rate", type=float, default=0.)
+    args = parser.parse_args()
+
+    print("[+] Serving {} channels on http://127.0.0.1:{}/api/app/".format(
+            args.channels, args.port))
+    serve(SyntheticICG(args.channels, args.values, seed=args.seed),
+            args.port, args.latency, args.jitter, args.error_rate)
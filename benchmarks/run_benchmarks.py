@@ -0,0 +1,275 @@
+"""
+Timed benchmarks of every stage (fetch, assembly, normalization, embedding,
+clustering, Bokeh output) on synthetic families (see icg_fixture.py) of 1k,
+10k and 50k channels. Every size runs in a fresh process, so the peak RSS
+of a record belongs to that size only. The records are written as json lines
+to benchmarks/results/<date>-<git revision>.jsonl and compared with the
+previous results file, regressions beyond --threshold are flagged.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--sizes 1000 10000 50000]
+        [--stages fetch assembly ...] [--latency 0.01] [--backend sklearn]
+        [--max-channels embedding 10000]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from queue import Empty
+
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+from data_extraction_processing import assemble_family_frame
+from instrumentation import METRICS
+from icg_fixture import SyntheticICG, MockICGServer
+
+STAGES = ["fetch", "assembly", "normalization", "embedding", "clustering",
+            "bokeh"]
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                        cwd=BENCHMARK_DIR,
+                                        stderr=subprocess.DEVNULL) \
+                    .decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+
+def environment():
+    import sklearn
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "sklearn": sklearn.__version__,
+            "machine": platform.machine(), "system": platform.system(),
+            "cpus": os.cpu_count()}
+
+
+
+def benchmark_size(n_channels, args):
+    """
+    Definition
+        Runs the selected stages on a synthetic family of n_channels. A
+        stage whose input is missing (skipped or failed stage before it)
+        runs on an untimed stand-in: the fixture generated directly instead
+        of fetched, the first two normalized columns instead of an
+        embedding.
+
+    Outputs:
+        records (list): one dictionary per stage
+    """
+    from preprocessing import normalized_trace_matrix, pca_reduce, ION_DIM
+    from embedding import embed
+    from clustering import fit_clusters
+    from trace_store import write_trace_store
+    from metadata_index import MetadataIndex
+
+    fixture = SyntheticICG(n_channels, args.values, seed=args.seed)
+    limits = {stage: int(limit) for stage, limit in args.max_channels}
+    records = []
+
+    def run(stage, function):
+        if (stage not in args.stages or \
+                n_channels > limits.get(stage, n_channels)):
+            return None
+        METRICS.reset()
+        print("[+] {} channels: {}".format(n_channels, stage), flush=True)
+        try:
+            with METRICS.stage(stage, items=n_channels) as record:
+                result = function()
+        except Exception:
+            record = {"stage": stage, "items": n_channels,
+                        "error": traceback.format_exc(limit=3)}
+            print(record["error"])
+            result = None
+        record = dict(record, n_channels=n_channels,
+                        counters=METRICS.summary()["counters"])
+        records.append(record)
+        return result
+
+    def fetch():
+        from icg_harvester import ICGHarvester
+        with MockICGServer(fixture, latency=args.latency,
+                            jitter=args.jitter) as server, \
+                ICGHarvester(base_url=server.base_url,
+                                max_workers=args.workers,
+                                requests_per_second=None) as harvester:
+            id_list = harvester.fetch_channel_ids(2)
+            fetched = {_id: (meta, trace) for _id, meta, trace in \
+                        harvester.harvest(id_list, progress_every=0)}
+        return id_list, fetched
+
+    fetched = run("fetch", fetch) or fixture.fetched()
+    assembled = run("assembly",
+                    lambda: assemble_family_frame(fetched[0], "Na", fetched[1]))
+    if (assembled is None):
+        assembled = assemble_family_frame(fetched[0], "Na", fetched[1])
+    del fetched
+    final_df, trace_block, protocols = assembled
+
+    data_array = run("normalization",
+                        lambda: normalized_trace_matrix(trace_block))
+    if (data_array is None):
+        data_array = normalized_trace_matrix(trace_block)
+
+    def embedding():
+        reduced, _ = pca_reduce(data_array, ION_DIM["Na"],
+                                random_state=args.seed)
+        return embed(reduced, backend=args.backend, n_jobs=args.n_jobs,
+                        seed=args.seed)
+
+    data2d = run("embedding", embedding)
+    if (data2d is None):
+        data2d = np.ascontiguousarray(data_array[:, :2])
+
+    kmeans = run("clustering", lambda: fit_clusters(data2d, n_clusters=10,
+                                                    seed=args.seed))
+    labels = kmeans.labels_ if kmeans is not None else \
+                np.zeros(n_channels, dtype=np.int32)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def bokeh():
+            from display_interactive_plot import interactive_plot_bokeh
+            store_prefix = os.path.join(tmp_dir, "Na_family")
+            write_trace_store(store_prefix, final_df, trace_block,
+                                protocols=protocols)
+            MetadataIndex.build(final_df).save(store_prefix)
+            plot_file = os.path.join(tmp_dir, "plot_values.pickle")
+            pd.DataFrame({"Value1": data2d[:, 0], "Value2": data2d[:, 1],
+                            "Cluster": labels}).to_pickle(plot_file)
+            return interactive_plot_bokeh(plot_file, store_prefix,
+                                out_file=os.path.join(tmp_dir, "map.html"),
+                                open_browser=False)
+        run("bokeh", bokeh)
+
+    return records
+
+
+
+def benchmark_size_worker(n_channels, args, queue):
+    queue.put(benchmark_size(n_channels, args))
+
+
+
+def compare(records, previous_file, threshold):
+    """
+    Prints the wall time of every (stage, size) against the previous results
+    file and returns the records which got slower by more than threshold.
+    """
+    previous = {}
+    with open(previous_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if ("wall_seconds" in record):
+                previous[(record["stage"], record["n_channels"])] = \
+                    record["wall_seconds"]
+
+    print("[+] Compared with", previous_file)
+    print("{:>14} {:>9} {:>12} {:>12} {:>8}".format("stage", "channels",
+                                                    "before [s]", "now [s]",
+                                                    "ratio"))
+    regressions = []
+    for record in records:
+        key = (record["stage"], record["n_channels"])
+        if (key not in previous or "wall_seconds" not in record):
+            continue
+        ratio = record["wall_seconds"] / max(previous[key], 1e-9)
+        flag = "  <- slower" if ratio > threshold else ""
+        if (flag):
+            regressions.append(record)
+        print("{:>14} {:>9} {:>12.3f} {:>12.3f} {:>8.2f}{}".format(key[0],
+                key[1], previous[key], record["wall_seconds"], ratio, flag))
+    return regressions
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 50000])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--max-channels", nargs=2, action="append",
+                        default=[], metavar=("STAGE", "N"),
+                        help="skip a stage above N channels")
+    parser.add_argument("--values", type=int, default=200,
+                        help="values per protocol trace")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="response delay of the mock api in seconds")
+    parser.add_argument("--jitter", type=float, default=0.)
+    parser.add_argument("--workers", type=int, default=8,
+                        help="concurrent requests of the harvester")
+    parser.add_argument("--backend", default="bhsne")
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", default=None,
+                        help="results file to compare with, by default the \
+                                latest one in the results directory")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="wall time ratio reported as regression")
+    args = parser.parse_args()
+
+    previous_file = args.compare
+    if (previous_file is None):
+        existing = sorted(glob.glob(os.path.join(args.results_dir, "*.jsonl")))
+        previous_file = existing[-1] if existing else None
+
+    run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + git_revision()
+    header = {"run": run_id, "env": environment(),
+                "params": {key: value for key, value in vars(args).items() \
+                            if key not in ("results_dir", "compare")}}
+
+    records = []
+    for n_channels in args.sizes:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=benchmark_size_worker,
+                                            args=(n_channels, args, queue))
+        process.start()
+        while (True):
+            try:
+                size_records = queue.get(timeout=5)
+                break
+            except Empty:
+                # e.g. killed when running out of memory
+                if (not process.is_alive()):
+                    size_records = [{"stage": "all", "n_channels": n_channels,
+                                    "error": "worker exited with code {}" \
+                                        .format(process.exitcode)}]
+                    break
+        process.join()
+        records.extend(dict(record, run=run_id) for record in size_records)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_file = os.path.join(args.results_dir, run_id + ".jsonl")
+    with open(results_file, "w") as f:
+        for record in [header] + records:
+            f.write(json.dumps(record) + "\n")
+
+    print("{:>14} {:>9} {:>10} {:>10} {:>10} {:>12}".format("stage",
+            "channels", "wall [s]", "cpu [s]", "rss [MB]", "channels/s"))
+    for record in records:
+        if ("error" in record):
+            print("{:>14} {:>9}     failed".format(record["stage"],
+                                                    record["n_channels"]))
+            continue
+        print("{:>14} {:>9} {:>10.3f} {:>10.3f} {:>10.0f} {:>12.0f}".format(
+                record["stage"], record["n_channels"], record["wall_seconds"],
+                record["cpu_seconds"], record["peak_rss_mb"] or 0,
+                record.get("items_per_second", 0)))
+    print("[+] Results saved in", results_file)
+
+    if (previous_file is not None):
+        compare(records, previous_file, args.threshold)
@@ -0,0 +1,106 @@
+import json
+import os
+import time
+
+
+
+class ChannelCheckpoint():
+    """
+    Definition
+        Durable, append-only store of fetched channels, one json object per
+        line. Every channel (ID, metadata attribute list, traces per
+        protocol) is appended and flushed as soon as it arrives, so a crashed family
+        dump can be resumed without fetching the stored channels again.
+        Additionally the id listing of every run is recorded, so a later run
+        knows which channels are new.
+
+        Line formats:
+            {"ID": 2706, "Meta": [[...], ...],
+             "Conc_Trace": {"Action Potential": [...], ...}}
+            {"Listing": [2706, ...], "Time": 1530000000.0}
+
+    Args:
+        file_name (str): path of the checkpoint file
+        sync_every (int): fsync the file after that many appended channels
+    """
+
+    def __init__(self, file_name, sync_every=1):
+        self.file_name = file_name
+        self.sync_every = sync_every
+        self.n_unsynced = 0
+        self.f = None
+
+    def load(self):
+        """
+        Definition
+            Reads all stored channels. A torn last line (crash while writing)
+            is cut off, so that appending continues on a clean line.
+
+        Outputs:
+            channels (dict): id -> (metadata attribute list, traces)
+            last_listing (list): id listing of the previous run, None if
+                                    none was recorded
+        """
+        channels = {}
+        last_listing = None
+        if (not os.path.exists(self.file_name)):
+            return channels, last_listing
+
+        valid_bytes = 0
+        with open(self.file_name, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf8"))
+                except ValueError:
+                    break
+                if (not line.endswith(b"\n")):
+                    break
+                valid_bytes += len(line)
+
+                if ("Listing" in record):
+                    last_listing = record["Listing"]
+                else:
+                    channels[record["ID"]] = (record["Meta"],
+                                                record["Conc_Trace"])
+
+        if (valid_bytes != os.path.getsize(self.file_name)):
+            print("[!] Dropping torn record at the end of", self.file_name)
+            with open(self.file_name, "r+b") as f:
+                f.truncate(valid_bytes)
+
+        return channels, last_listing
+
+    def _write(self, record):
+        if (self.f is None):
+            self.f = open(self.file_name, "a")
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self.n_unsynced += 1
+        if (self.n_unsynced >= self.sync_every):
+            os.fsync(self.f.fileno())
+            self.n_unsynced = 0
+
+    def append(self, channel_id, meta, trace):
+        self._write({"ID": channel_id, "Meta": meta, "Conc_Trace": trace})
+
+    def record_listing(self, id_list, timestamp=True):
+        """
+        Records the id listing of a run, with its time unless timestamp is
+        False (e.g. for files which must be identical for identical data).
+        """
+        record = {"Listing": list(id_list)}
+        if (timestamp):
+            record["Time"] = time.time()
+        self._write(record)
+
+    def close(self):
+        if (self.f is not None):
+            os.fsync(self.f.fileno())
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,97 @@
+import colorsys
+import os
+import pickle
+
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from instrumentation import stage
+
+# former fixed palette, kept as the first colors so small maps look the same
+BASE_COLORS = ["b", "g", "r", "c", "y", "m", "k", "fuchsia", "gray", "navy", \
+                "coral"]
+
+# above that many datapoints MiniBatchKMeans is used (with minibatch="auto")
+MINIBATCH_THRESHOLD = 50000
+
+
+
+def cluster_palette(n_clusters):
+    """
+    Returns a list of n_clusters distinct colors: the base palette, followed
+    by generated colors whose hues are spread by the golden ratio.
+    """
+    colors = BASE_COLORS[:n_clusters]
+    hue = 0.
+    while (len(colors) < n_clusters):
+        hue = (hue + 0.618033988749895) % 1.
+        red, green, blue = colorsys.hsv_to_rgb(hue, 0.75, 0.85)
+        colors.append("#{:02x}{:02x}{:02x}".format(int(red*255),
+                                                    int(green*255),
+                                                    int(blue*255)))
+    return colors
+
+
+
+def load_cluster_model(model_file):
+    with open(model_file, "rb") as f:
+        return pickle.load(f)
+
+
+
+def save_cluster_model(model, model_file):
+    tmp_name = model_file + ".tmp"
+    with open(tmp_name, "wb") as f:
+        pickle.dump(model, f)
+    os.replace(tmp_name, model_file)
+
+
+
+def fit_clusters(data2d, n_clusters=10, seed=0, minibatch="auto",
+                    model_file=None, warm_start=True, batch_size=4096):
+    """
+    Definition
+        Seeded (i.e. reproducible) KMeans clustering of the embedding. For
+        big (merged) datasets MiniBatchKMeans is used. If model_file holds a
+        previous model with the same number of clusters, its centroids are
+        used as initialisation (a single warm started run instead of several
+        random ones). The fitted model is saved to model_file.
+
+    Args:
+        data2d (np.ndarray): (n_channels x 2) embedding
+        n_clusters (int): number of clusters
+        seed (int): random seed
+        minibatch (bool or "auto"): use MiniBatchKMeans, "auto" above
+                                    MINIBATCH_THRESHOLD datapoints
+        model_file (str): pickle of the model, None disables persistence
+        warm_start (bool): start from the centroids in model_file
+        batch_size (int): batch size of MiniBatchKMeans
+
+    Outputs:
+        kmeans (KMeans or MiniBatchKMeans): fitted model, labels_ holds the
+                                            cluster of every datapoint
+    """
+    if (minibatch == "auto"):
+        minibatch = len(data2d) > MINIBATCH_THRESHOLD
+
+    init, n_init = "k-means++", 10
+    if (warm_start and model_file is not None and os.path.exists(model_file)):
+        previous = load_cluster_model(model_file)
+        centers = previous.cluster_centers_
+        if (centers.shape == (n_clusters, data2d.shape[1])):
+            init, n_init = centers.astype(data2d.dtype), 1
+            print("[+] Warm starting clustering from", model_file)
+
+    if (minibatch):
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init,
+                                    n_init=n_init, batch_size=batch_size,
+                                    random_state=seed)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, init=init, n_init=n_init,
+                        random_state=seed)
+    with stage("kmeans", items=len(data2d), minibatch=bool(minibatch)):
+        kmeans.fit(data2d)
+
+    if (model_file is not None):
+        save_cluster_model(kmeans, model_file)
+
+    return kmeans
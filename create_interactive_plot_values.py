@@ -1,99 +1,136 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import json
 import pickle
-from tsne import bh_sne
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
 from mpldatacursor import datacursor
-from prettytable import PrettyTable
+from trace_store import TraceStore
+from preprocessing import normalized_trace_matrix, pca_reduce, ION_DIM
+from embedding import embed
+from embedding_model import EmbeddingModel
+from clustering import fit_clusters
 
 def collect_and_save_plot_information(main_df, reduced_dim=2, perplexity=30, \
-                                        n_kmeans_clusters=10):
+                                        n_kmeans_clusters=10, dtype=np.float64,
+                                        pca_dim=None, pca_cache=None,
+                                        backend="bhsne", n_jobs=-1, seed=0,
+                                        plot_file="Interactive_Plot_Values.pickle",
+                                        model_file=None, cluster_file=None,
+                                        minibatch="auto", protocols=None):
     """
     Definition
         Reduces Dimensionality of Voltage Traces via t-SNE. Then applies
-        K-means clustering. Also creates information strings for each datapoint
-        containing its metadata. Finally saves it all in a pickle, for the
-        script "display_interactive_plot.py" to use.
+        K-means clustering. Finally saves the coordinates and clusters in a
+        pickle, for the script "display_interactive_plot.py" to use (which
+        creates the information strings of the datapoints from the metadata
+        on demand).
+        The trace matrix is built with the given dtype, float32 halves its
+        memory. With pca_dim, the traces are first projected onto their
+        pca_dim principal components (see ION_DIM), the fitted projection
+        is cached in the pickle pca_cache.
+        The embedding backend (see embedding.EMBEDDING_BACKENDS), its number
+        of threads n_jobs and its seed (also used by the clustering) are
+        configurable.
+        The KMeans model is saved next to the plot values (cluster_file,
+        defaults to "<plot_file>_kmeans.pickle") and its centroids warm start
+        the clustering of later runs; for big datasets MiniBatchKMeans is
+        used (see clustering.fit_clusters).
+        With model_file, the fitted normalization, PCA, embedding and KMeans
+        are pickled as an EmbeddingModel, so add_new_channels can place
+        channels published later into this map. If main_df only holds some
+        protocols (TraceStore.to_dataframe(protocols=...)), pass the same
+        protocols, so the new channels are selected alike.
     """
 
 
     # dataframe for saving plotting values later on
-    plot_df = pd.DataFrame(columns=["Value1", "Value2", "Color", "Label"])
-
-    # create a numpy array for voltage trace values to apply dim reduction
-    # and clustering
-    n_channels = len(main_df['Conc_Trace'])
-    n_trace_values = len(main_df['Conc_Trace'][0])
-    data_array = np.zeros((n_channels, n_trace_values))
-
-    # copy values into numpy array from dataframe
-    for row in range(n_channels):
-        data_array[row] = main_df['Conc_Trace'][row]
-
-    """
-    "we normalized each column by Z-scoring: we substracted its mean and
-    then divided by its standard deviation"
-    """
-    for column in range(n_trace_values):
-        data_array[:,column] = (data_array[:,column] - \
-                                np.mean(data_array[:,column])) / \
-                                np.std(data_array[:,column])
-
-    # apply t-SNE on data
-    data2d = bh_sne(data_array, d=reduced_dim, perplexity=perplexity)
+    plot_df = pd.DataFrame(columns=["Value1", "Value2", "Cluster"])
+
+    # create the Z-scored numpy array of voltage trace values to apply dim
+    # reduction and clustering
+    data_array, mean, std = normalized_trace_matrix(main_df, dtype=dtype,
+                                                    return_stats=True)
+    n_channels = data_array.shape[0]
+
+    # reduce to the dimensionality of the paper before t-SNE
+    pca = None
+    if (pca_dim is not None):
+        data_array, pca = pca_reduce(data_array, pca_dim, cache_file=pca_cache)
+
+    # apply t-SNE (or another embedding backend) on data
+    data2d = embed(data_array, backend=backend, reduced_dim=reduced_dim,
+                    perplexity=perplexity, n_jobs=n_jobs, seed=seed)
     plot_df["Value1"] = data2d[:,0] # ... and save in the dataframe
     plot_df["Value2"] = data2d[:,1] # ... and save in the dataframe
 
 
     # apply kmeans and save its labels for colorization
-    kmeans = KMeans(n_clusters=n_kmeans_clusters)
-    kmeans.fit(data2d)
-    labels = kmeans.labels_
-    # for assigning different colors to different clusters
-    nr_to_color = ["b", "g", "r", "c", "y", "m", "k", "fuchsia",        \
-                    "gray", "navy", "coral"]
-    # convert clusters to colors
-    colors = [nr_to_color[cluster] for cluster in labels]
-    plot_df["Color"] = colors # ... and save in the dataframe
-
-
-    # create list of labels, which will be displayed when clicking
-    # on a datapoint
-    text_list = [create_label_for_matplotlib(main_df.loc[counter])      \
-    for counter in range(n_channels)]
-    plot_df["Label"] = text_list # ... and save in the dataframe
+    if (cluster_file is None):
+        cluster_file = os.path.splitext(plot_file)[0] + "_kmeans.pickle"
+    kmeans = fit_clusters(data2d, n_clusters=n_kmeans_clusters, seed=seed,
+                            minibatch=minibatch, model_file=cluster_file)
+    plot_df["Cluster"] = kmeans.labels_ # ... and save in the dataframe
+
+    # keep everything needed to place new channels into this map
+    if (model_file is not None):
+        EmbeddingModel(main_df['ID'].to_numpy(), mean, std, pca, data_array,
+                        data2d, kmeans, protocols=protocols).save(model_file)
 
     # now that we got all we need, save in pickle
-    plot_df.to_pickle("Interactive_Plot_Values.pickle")
+    plot_df.to_pickle(plot_file)
 
 
 
-def create_label_for_matplotlib(series_of_dp):
+def add_new_channels(store_prefix, model_file,
+                        plot_file="Interactive_Plot_Values.pickle",
+                        n_neighbors=10):
     """
     Definition
-        Creates a nice formatted string of all the value and they keys of a
-        panda series.
+        Incremental mode: places the channels of the trace store which are
+        not in the map yet (e.g. after an incremental family dump) into the
+        existing map, without refitting the embedding. Each new channel is
+        put between its nearest already embedded neighbours and assigned to
+        an existing cluster via KMeans.predict. The plot values are then
+        rewritten in the row order of the store, and the updated model
+        saved again.
     """
-    label = PrettyTable(["Attribute", "Value"])
-    exclude = ["Conc_Trace", "Temperature"]
-    for attribute in series_of_dp.keys():
-        if (attribute not in exclude):
-            label.add_row([attribute, series_of_dp[attribute]])
+    store = TraceStore(store_prefix)
+    model = EmbeddingModel.load(model_file)
 
-    return str(label)
+    ids = store.meta['ID'].to_numpy()
+    rows = model.rows_of(ids)
+    new = rows < 0
+    if (new.any()):
+        # the protocols the map was embedded from (models pickled before
+        # they were recorded used all of them)
+        traces = store.select(getattr(model, "protocols", None))
+        model.add(ids[new], traces[new], n_neighbors=n_neighbors)
+        rows = model.rows_of(ids)
+        model.save(model_file)
+    print("[+] Placed", int(new.sum()), "new channels into the map")
+
+    plot_df = pd.DataFrame({"Value1": model.data2d[rows, 0],
+                            "Value2": model.data2d[rows, 1],
+                            "Cluster": model.clusters[rows]})
+    plot_df.to_pickle(plot_file)
 
 
 
 if (__name__=="__main__"):
     # number of dimensions the data was reduced too in the paper
     # corresponding to the ion
-    ion_dim = {"K":16, "Na":21, "Ca":29, "IH":16, "KCa":16}
+    ion_dim = ION_DIM
 
     # Get traces
-    file_name = "Na_family_dataframe.pickle"
-    main_df = pd.read_pickle(file_name)
-
-    collect_and_save_plot_information(main_df)
+    store_prefix = "Na_family"
+    # (e.g. ["Inactivation", "Activation"] to only embed those protocols)
+    protocols = None
+    main_df = TraceStore(store_prefix).to_dataframe(protocols=protocols)
+
+    collect_and_save_plot_information(main_df, pca_dim=ion_dim["Na"],
+                                        pca_cache="Na_family_pca.pickle",
+                                        model_file="Na_family_model.pickle",
+                                        protocols=protocols)
+    # later, after new channels were dumped, instead of a full refit:
+    # add_new_channels(store_prefix, "Na_family_model.pickle")
@@ -3,39 +3,82 @@ import json
 import matplotlib.pyplot as plt
 import pprint
 import pandas as pd
+import numpy as np
+from instrumentation import timed_get, stage
 
-def channel_id_getter(family_id=2):
-    # TODO check if 4/IH = Hyperpolarization-activated Channel
+# base url of the icg api; can be pointed to a local stand-in server
+ICG_API_URL = "https://icg.neurotheory.ox.ac.uk:443/api/app/"
+
+# all 5 available trace (protocol) names, in the order they get concatenated
+TRACE_NAMES = ['Action Potential', 'Inactivation', 'Activation', 'Ramp', \
+                'Deactivation']
+
+# specify all category names you want to include in meta data
+# Note: index of the dictionary will be used to reference elements of the
+# attribute list returned by metadata_getter
+METADATA_INDEX = {'Animal Model':0, 'Brain Area':1, 'Neuron Region':2, \
+                 'Neuron Type':3, 'Runtime Q':4, 'Subtype':5,  'Age':6, \
+                 'Authors':7, 'Temperature':8}
+
+# column names of the metadata in the family dataframe, same order as above
+METADATA_COLUMNS = ['Animal_Model', 'Brain_Area', 'Neuron_Region', \
+                    'Neuron_Type', 'Runtime_Q', 'Subtype', 'Age', 'Author', \
+                    'Temperature']
+
+FAMILY_ID_TO_NAME = {1:"K", 2:"Na", 3:"Ca", 4:"IH", 5:"KCa"}
+
+
+
+def family_url(family_id, base_url=ICG_API_URL):
     """
-    Given a family id (with 1=Potassium Channel, 2=Sodium Channel,
-    3=Calcium Channel, 4:Hyperpolarization-activated Channel,
-    5:Calcium-dependent Potassium Channel) returns a list with all
-    corresponding channel ids from icg
+    Returns the api url listing all channels of a family.
+    """
+    return base_url + "families/" + str(family_id) + "/"
 
-    Args:
-        family_id (int): family id
 
-    Outputs:
-        id_list (list): list with all ids corresponding to the given family_id
+
+def trace_url(channel_id, base_url=ICG_API_URL):
+    """
+    Returns the api url of the traces of a channel.
     """
+    return base_url + "chs/" + str(channel_id) + "/traces"
+
+
+
+def metadata_url(channel_id, base_url=ICG_API_URL):
+    """
+    Returns the api url of the metadata of a channel.
+    """
+    return base_url + "chs/" + str(channel_id)
 
-    id_list = []
 
-    # get response
-    url = "https://icg.neurotheory.ox.ac.uk:443/api/app/families/" + \
-            str(family_id) + "/"
-    response = requests.get(url)
 
+def response_to_json(response):
+    """
+    Checks the status of an api response and decodes its json body.
+
+    Args:
+        response (requests.Response): response of the icg api
+
+    Outputs:
+        data (dict): decoded json object
+    """
     # check for right response status
     if (response.status_code != 200):
         raise ValueError("[!] Response Status from API is not 200, \
         but instead {}!".format(response.status_code))
 
-    # from byte to json object to pure id lists
+    # from byte to json object
     my_json = response.content.decode("utf8")
-    data = json.loads(my_json)
+    return json.loads(my_json)
 
 
+
+def parse_channel_ids(data):
+    """
+    Extracts the list of channel ids from a decoded family json object.
+    """
+    id_list = []
     for counter in range(data["count"]):
         id_list.append(data["chans"][counter]["id"])
 
@@ -43,116 +86,159 @@ def channel_id_getter(family_id=2):
 
 
 
-def trace_getter(channel_id=2706):
+def parse_trace_dict(data, protocols=TRACE_NAMES):
     """
-    Returns all 5 traces of a channel id (corresponding to a channel on
-    https://icg.neurotheory.ox.ac.uk) in a dictionary.
-
-    Args:
-        channel_id (int):  id of the channel on icg
-
-    Outputs:
-        trace_dict (dict): dictionary with 5 traces: Action Potential,
-                            Inactivation, Activation, Ramp, Deactivation
+    Extracts the traces of the given protocols from a decoded trace json
+    object into a dictionary protocol:list, in the order of protocols.
     """
-    # all 5 available trace names
-    trace_dict = {'Action Potential':[], 'Inactivation':[], 'Activation':[], \
-                'Ramp':[], 'Deactivation':[]}
-    trace_list = []
+    traces = data["traces"][0]["traces"] # get traces
 
-    # get response
-    url_trace = "https://icg.neurotheory.ox.ac.uk:443/api/app/chs/" + \
-            str(channel_id) + "/traces"
-    response = requests.get(url_trace)
+    return {dict_key: traces[dict_key]["data"][0] for dict_key in protocols}
 
-    # check for right response status
-    if (response.status_code != 200):
-        raise ValueError("[!] Response Status from API is not 200, \
-        but instead {}!".format(response.status_code))
 
-    # from byte to json object to pure data lists
-    my_json = response.content.decode("utf8")
-    data = json.loads(my_json)
-    traces = data["traces"][0]["traces"] # get traces
 
+def parse_traces(data, protocols=TRACE_NAMES):
     """
-    # iterate through every trace --> produces dict with 5 keys
-    for dict_key in trace_dict.keys():
-        trace_dict[dict_key] = traces[dict_key]["data"][0]
+    Concatenates the traces of the given protocols (by default all 5) of a
+    decoded trace json object into one list.
     """
+    trace_list = []
 
-    # iterate through every channel and append them to one big list
-    # TODO done differently in the paper, depending on whether
-    # it was a Ca channel
-    for dict_key in trace_dict.keys():
-        trace_list.extend(traces[dict_key]["data"][0])
+    # iterate through every protocol and append them to one big list
+    # (the paper chose the protocols depending on whether it was a Ca
+    # channel, which is what the protocols argument is for)
+    for trace in parse_trace_dict(data, protocols).values():
+        trace_list.extend(trace)
 
     return trace_list
 
 
 
-def metadata_getter(channel_id=2706):
+def parse_metadata(data):
     """
-    Returns metadata of a channel id (corresponding to a channel on
-    https://icg.neurotheory.ox.ac.uk) in a dictionary.
-
-    Args:
-        channel_id (int):  id of the channel on icg
-
-    Outputs:
-        TODO
+    Extracts the attribute list (ordered as in METADATA_INDEX) from a decoded
+    metadata json object.
     """
-
-    # specify all category names you want to include in meta data
-    index_list = {'Animal Model':0, 'Brain Area':1, 'Neuron Region':2, \
-                 'Neuron Type':3, 'Runtime Q':4, 'Subtype':5,  'Age':6, \
-                 'Authors':7, 'Temperature':8}
     # specify an list for the actual attributes
-    # Note: index of the dictionary above will be used to reference elements
-    # of this list
-    attr_list = [[]]*len(index_list.keys())
-
-    # get response
-    url_meta = "https://icg.neurotheory.ox.ac.uk:443/api/app/chs/" + \
-            str(channel_id)
-    response = requests.get(url_meta)
-
-    # check for right response status
-    if (response.status_code != 200):
-        raise ValueError("[!] Response Status from API is not 200, \
-        but instead {}!".format(response.status_code))
+    attr_list = [[]]*len(METADATA_INDEX.keys())
 
-    # from byte to json object to pure data lists
-    my_json = response.content.decode("utf8")
     # data is a list of dictionaries, each with different properties
-    data_cls = json.loads(my_json)['cls']
-    data_meta = json.loads(my_json)['metadata']
-
-    # for visualization of the json object
-    #pprint.pprint(data)
+    data_cls = data['cls']
+    data_meta = data['metadata']
 
     # go through all the attribute dictionaries of cls data
     for attribute_dic in data_cls:
         # if we are intrested in the category
-        if (attribute_dic['name'] in index_list.keys()):
+        if (attribute_dic['name'] in METADATA_INDEX.keys()):
             # add, at the corresponding position on our attr_list, all the
             # 'name' values of all dictionaries in the 'cls' attribute
-            attr_list[index_list[attribute_dic['name']]] = \
+            attr_list[METADATA_INDEX[attribute_dic['name']]] = \
                 [thing['name'] for thing in attribute_dic['cls']]
 
     # do the same for metadata informations
     for attribute_dic in data_meta:
         # if we are intrested in the category
-        if (attribute_dic['name'] in index_list.keys()):
+        if (attribute_dic['name'] in METADATA_INDEX.keys()):
             # add, at the corresponding position on our attr_list, all the
             # 'name' values of all dictionaries in the 'cls' attribute
-            attr_list[index_list[attribute_dic['name']]] = \
+            attr_list[METADATA_INDEX[attribute_dic['name']]] = \
                 [attribute_dic['value']]
 
     return attr_list
 
 
 
+def channel_id_getter(family_id=2, session=requests, base_url=ICG_API_URL):
+    # TODO check if 4/IH = Hyperpolarization-activated Channel
+    """
+    Given a family id (with 1=Potassium Channel, 2=Sodium Channel,
+    3=Calcium Channel, 4:Hyperpolarization-activated Channel,
+    5:Calcium-dependent Potassium Channel) returns a list with all
+    corresponding channel ids from icg
+
+    Args:
+        family_id (int): family id
+        session (requests.Session): object used for the http get, defaults
+                                    to the plain requests module
+        base_url (str): base url of the icg api
+
+    Outputs:
+        id_list (list): list with all ids corresponding to the given family_id
+    """
+    # get response and convert from byte to json object to pure id lists
+    response = timed_get(session, family_url(family_id, base_url),
+                            endpoint="family")
+    data = response_to_json(response)
+
+    return parse_channel_ids(data)
+
+
+
+def trace_getter(channel_id=2706, session=requests, base_url=ICG_API_URL,
+                    protocols=TRACE_NAMES):
+    """
+    Returns all 5 traces of a channel id (corresponding to a channel on
+    https://icg.neurotheory.ox.ac.uk) concatenated into one list.
+
+    Args:
+        channel_id (int):  id of the channel on icg
+        session (requests.Session): object used for the http get
+        base_url (str): base url of the icg api
+        protocols (list): traces to include, by default all of TRACE_NAMES
+
+    Outputs:
+        trace_list (list): concatenation of the 5 traces: Action Potential,
+                            Inactivation, Activation, Ramp, Deactivation
+    """
+    # get response and convert from byte to json object to pure data lists
+    response = timed_get(session, trace_url(channel_id, base_url),
+                            endpoint="trace")
+    data = response_to_json(response)
+
+    return parse_traces(data, protocols)
+
+
+
+def trace_dict_getter(channel_id=2706, session=requests, base_url=ICG_API_URL,
+                        protocols=TRACE_NAMES):
+    """
+    Returns the traces of a channel id in a dictionary protocol:list, e.g.
+    for trace_plotter_complete.
+    """
+    response = timed_get(session, trace_url(channel_id, base_url),
+                            endpoint="trace")
+    data = response_to_json(response)
+
+    return parse_trace_dict(data, protocols)
+
+
+
+def metadata_getter(channel_id=2706, session=requests, base_url=ICG_API_URL):
+    """
+    Returns metadata of a channel id (corresponding to a channel on
+    https://icg.neurotheory.ox.ac.uk) in a list.
+
+    Args:
+        channel_id (int):  id of the channel on icg
+        session (requests.Session): object used for the http get
+        base_url (str): base url of the icg api
+
+    Outputs:
+        attr_list (list): list of attribute value lists, ordered as in
+                            METADATA_INDEX
+    """
+    # get response and convert from byte to json object to pure data lists
+    response = timed_get(session, metadata_url(channel_id, base_url),
+                            endpoint="metadata")
+    data = response_to_json(response)
+
+    # for visualization of the json object
+    #pprint.pprint(data)
+
+    return parse_metadata(data)
+
+
+
 
 def trace_plotter_complete(trace_dict, trace_id=-1):
     """
@@ -160,7 +246,9 @@ def trace_plotter_complete(trace_dict, trace_id=-1):
     https://icg.neurotheory.ox.ac.uk) in a dictionary.
 
     Args:
-        trace_dict (dict):  dictionary with all traces of a channel
+        trace_dict (dict):  dictionary with the traces of a channel, e.g. from
+                            trace_dict_getter or TraceStore.trace_dict; only
+                            the protocols present are plotted
         channel_id (int):      id of the channel on icg
     """
 
@@ -175,6 +263,7 @@ def trace_plotter_complete(trace_dict, trace_id=-1):
     # build plot
     plt.figure(plot_name, figsize=(20,10))
     plt.title(plot_name)
+    trace_names = [name for name in trace_names if name in trace_dict]
     for counter, trace_key in enumerate(trace_names):
         plt.subplot(2, 3, counter+1)
         plt.title(trace_key)
@@ -184,7 +273,86 @@ def trace_plotter_complete(trace_dict, trace_id=-1):
 
 
 
-def dump_family_as_json_with_trace(family_id=2):
+def assemble_family_frame(id_list, family_name, fetched, dtype=np.float64):
+    """
+    Builds the family dataframe in one shot. Metadata is collected into
+    preallocated column lists and all traces are copied into one contiguous
+    (n_channels x n_trace_values) array, so assembling costs O(N) instead of
+    growing a dataframe row by row.
+
+    Args:
+        id_list (list): channel ids, in the order of the rows
+        family_name (str): short name of the family, e.g. "Na"
+        fetched (dict): id -> (metadata attribute list, trace), the trace
+                        being either a dictionary protocol:list or the
+                        already concatenated list
+        dtype (np.dtype): dtype of the trace block
+
+    Outputs:
+        final_df (pd.DataFrame): columns ID, Family, Conc_Trace and the
+                                    METADATA_COLUMNS; each Conc_Trace entry is
+                                    a row view into trace_block
+        trace_block (np.ndarray): contiguous array of all traces
+        protocols (list): (protocol, start, stop) column ranges of every
+                            protocol in trace_block, None if the traces came
+                            already concatenated
+    """
+    n_channels = len(id_list)
+
+    # the protocol layout (and so the width) is taken from the first channel
+    protocols = None
+    first_trace = fetched[id_list[0]][1] if n_channels else []
+    if (isinstance(first_trace, dict)):
+        protocols = []
+        start = 0
+        for name, trace in first_trace.items():
+            protocols.append((name, start, start + len(trace)))
+            start += len(trace)
+        n_trace_values = start
+    else:
+        n_trace_values = len(first_trace)
+
+    # preallocated buffers, one per column
+    meta_columns = [[None]*n_channels for _ in METADATA_COLUMNS]
+    trace_block = np.empty((n_channels, n_trace_values), dtype=dtype)
+
+    for row, _id in enumerate(id_list):
+        meta, trace = fetched[_id]
+        for column, value in zip(meta_columns, meta):
+            column[row] = value
+
+        if (isinstance(trace, dict)):
+            if (protocols is None or \
+                    [name for name, _, _ in protocols] != list(trace.keys())):
+                raise ValueError("[!] Traces of channel {} have other \
+                protocols than the first channel!".format(_id))
+            for name, start, stop in protocols:
+                if (len(trace[name]) != stop - start):
+                    raise ValueError("[!] {} trace of channel {} has {} \
+                    values instead of {}!".format(name, _id,
+                                                    len(trace[name]),
+                                                    stop - start))
+                trace_block[row, start:stop] = trace[name]
+        else:
+            if (len(trace) != n_trace_values):
+                raise ValueError("[!] Trace of channel {} has {} values \
+                instead of {}!".format(_id, len(trace), n_trace_values))
+            trace_block[row] = trace
+
+    columns = {'ID': np.asarray(id_list),
+                'Family': [family_name]*n_channels,
+                'Conc_Trace': list(trace_block)}
+    columns.update(zip(METADATA_COLUMNS, meta_columns))
+    final_df = pd.DataFrame(columns)
+
+    return final_df, trace_block, protocols
+
+
+
+def dump_family_as_json_with_trace(family_id=2, base_url=ICG_API_URL,
+                                    max_workers=8, requests_per_second=10.,
+                                    cache_dir=None, offline=False,
+                                    incremental=False, protocols=TRACE_NAMES):
     # TODO check if 4/IH = Hyperpolarization-activated Channel
     """
     Given a family id (with 1=Potassium Channel, 2=Sodium Channel,
@@ -195,47 +363,82 @@ def dump_family_as_json_with_trace(family_id=2):
 
     Args:
         family_id (int): family id
+        base_url (str): base url of the icg api
+        max_workers (int): number of channels fetched concurrently
+        requests_per_second (float): maximal request rate to the api
+        cache_dir (str): directory of a persistent response cache, None
+                            disables caching
+        offline (bool): run purely from the response cache, needs a
+                        cache_dir
+        incremental (bool): checkpoint every fetched channel in
+                            "<Family>_family_checkpoint.jsonl" and only fetch
+                            channels which are not stored there yet
+        protocols (list): traces to fetch and store, by default all of
+                            TRACE_NAMES; their column ranges are kept in the
+                            trace store
     """
-
-    family_id_to_name = {1:"K", 2:"Na", 3:"Ca", 4:"IH", 5:"KCa"}
+    # imported here, since the harvester itself builds on the getters above
+    from icg_harvester import ICGHarvester, pooled_session
+    from icg_cache import ResponseCache
+    from channel_checkpoint import ChannelCheckpoint
+    from trace_store import write_trace_store
+    from metadata_index import MetadataIndex
+
+    family_id_to_name = FAMILY_ID_TO_NAME
     big_dict = {}
 
-    # create pandas dataframe
-    channel_df = pd.DataFrame()
-
-    # get all ids of corresponding channels
-    id_list = channel_id_getter(family_id)
-    # add ids to the dataframe and its family
-    channel_df['ID'] = id_list
-    channel_df['Family'] = [family_id_to_name[family_id] for i in range(len(id_list))]
-
-
-    # go through every id and get its metadata, and create a new dataframe with
-    # those informations
-    meta_df = pd.DataFrame(columns=['Animal_Model', 'Brain_Area',              \
-                'Neuron_Region', 'Neuron_Type', 'Runtime_Q', 'Subtype', 'Age', \
-                'Author', 'Temperature'])
-
-    for counter, _id in enumerate(id_list):
-        if (counter % 100 == 0):
-            print(counter, "of", len(id_list))
-        meta_df.loc[len(meta_df)] = metadata_getter(_id)
-
-
-
-    # go through every id and get it trace, save it in a dataframe
-    for counter, _id in enumerate(id_list):
-        # What basically is done here:
-        #   For every id, localise the entry where the id is in the column
-        #   "ID" and set its attribute "Conc_Trace" to the extracted voltage
-        #   trace (hacked)
-        if (counter % 100 == 0):
-            print(counter, "of", len(id_list))
-        channel_df.loc[channel_df['ID']==_id, 'Conc_Trace'] =            \
-            pd.Series([trace_getter(_id)],                               \
-            index = [channel_df.loc[channel_df['ID']==_id].index[0]])
-
-    final_df = pd.concat([channel_df, meta_df], axis=1)
+    if (offline and cache_dir is None):
+        raise ValueError("[!] Running offline needs the cache_dir of a \
+        response cache!")
+    session = None
+    if (cache_dir is not None):
+        session = ResponseCache(cache_dir, session=pooled_session(max_workers),
+                                offline=offline)
+
+    # timing and channels/sec of the fetch (see instrumentation)
+    with stage("fetch", family=family_id_to_name[family_id]) as record, \
+            ICGHarvester(base_url=base_url, max_workers=max_workers,
+                        requests_per_second=requests_per_second,
+                        session=session, protocols=protocols) as harvester:
+        # get all ids of corresponding channels
+        id_list = harvester.fetch_channel_ids(family_id)
+
+        if (not incremental):
+            # fetch metadata and trace of every id concurrently
+            record["items"] = len(id_list)
+            fetched = {_id: (meta, trace) for _id, meta, trace in \
+                        harvester.harvest(id_list)}
+        else:
+            checkpoint_name = family_id_to_name[family_id] + \
+                                "_family_checkpoint.jsonl"
+            with ChannelCheckpoint(checkpoint_name) as checkpoint:
+                fetched, last_listing = checkpoint.load()
+                # channels checkpointed with another protocol selection, or
+                # as one concatenated trace (checkpoints written before the
+                # protocols were kept), are fetched again
+                fetched = {_id: (meta, trace) for _id, (meta, trace) in \
+                            fetched.items() if isinstance(trace, dict) \
+                            and list(trace.keys()) == list(protocols)}
+                # only fetch channels which are not checkpointed yet, i.e.
+                # the ones of an interrupted run or new since the last listing
+                missing_ids = [_id for _id in id_list if _id not in fetched]
+                print("[+] {} of {} channels already checkpointed".format( \
+                        len(id_list) - len(missing_ids), len(id_list)))
+                if (last_listing is not None):
+                    print("[+] {} channels are new since the last listing" \
+                            .format(len(set(id_list) - set(last_listing))))
+                checkpoint.record_listing(id_list)
+
+                record["items"] = len(missing_ids)
+                for _id, meta, trace in harvester.harvest(missing_ids):
+                    checkpoint.append(_id, meta, trace)
+                    fetched[_id] = (meta, trace)
+
+    # build the dataframe with ids, family, traces and metadata in one go
+    with stage("assemble", items=len(id_list),
+                family=family_id_to_name[family_id]):
+        final_df, trace_block, trace_protocols = assemble_family_frame(id_list,
+                                    family_id_to_name[family_id], fetched)
 
     print(final_df)
     print(len(final_df['Conc_Trace'][0]))
@@ -246,14 +449,19 @@ def dump_family_as_json_with_trace(family_id=2):
     with open(file_name, 'w') as fp:
         json.dump(big_dict, fp)
     """
-    file_name = family_id_to_name[family_id] + "_family_dataframe.pickle"
-    final_df.to_pickle(file_name)
-    # NOTE: To read data use: .kpd.read_pickle(file_name)
+    # traces go into a memory mappable matrix, everything else into a sidecar
+    # NOTE: To read data use: trace_store.TraceStore(store_prefix)
+    store_prefix = family_id_to_name[family_id] + "_family"
+    trace_name, meta_name = write_trace_store(store_prefix, final_df,
+                                                trace_block,
+                                                protocols=trace_protocols)
+    # inverted index from metadata values to rows, for fast filtering
+    MetadataIndex.build(final_df).save(store_prefix)
 
     print("[+] Saved " + family_id_to_name[family_id] + \
-            " Family Trace in:", file_name)
+            " Family Trace in:", trace_name, "and", meta_name)
 
 
 
 if __name__=="__main__":
-    dump_family_as_json_with_trace(2)
+    dump_family_as_json_with_trace(2, cache_dir="icg_cache")
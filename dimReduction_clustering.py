@@ -2,88 +2,63 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import json
-from tsne import bh_sne
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
-from mpldatacursor import datacursor
-from prettytable import PrettyTable
-
-def dim_reduction(main_df, reduced_dim=2, perplexity=30, n_kmeans_clusters=10):
-
-    # create a numpy array for voltage trace values
-    n_channels = len(main_df['Conc_Trace'])
-    n_trace_values = len(main_df['Conc_Trace'][0])
-    data_array = np.zeros((n_channels, n_trace_values))
-
-    # copy values
-    for row in range(n_channels):
-        data_array[row] = main_df['Conc_Trace'][row]
-
-    """
-    "we normalized each column by Z-scoring: we substracted its mean and
-    then divided by its standard deviation"
-    """
-    for column in range(n_trace_values):
-        data_array[:,column] = (data_array[:,column] - \
-                                np.mean(data_array[:,column])) / \
-                                np.std(data_array[:,column])
-
-    # apply t-SNE on data
-    data2d = bh_sne(data_array, d=reduced_dim, perplexity=perplexity)
+from clustering import fit_clusters, cluster_palette
+from display_interactive_plot import scatter_by_color, enable_point_info
+from point_labels import LabelRenderer
+from trace_store import TraceStore
+from preprocessing import normalized_trace_matrix, pca_reduce, ION_DIM
+from embedding import embed
+
+def dim_reduction(main_df, reduced_dim=2, perplexity=30, n_kmeans_clusters=10,
+                    dtype=np.float64, pca_dim=None, pca_cache=None,
+                    backend="bhsne", n_jobs=-1, seed=0):
+
+    # create the Z-scored numpy array of voltage trace values to apply dim
+    # reduction and clustering
+    data_array = normalized_trace_matrix(main_df, dtype=dtype)
+    n_channels = data_array.shape[0]
+
+    # reduce to the dimensionality of the paper before t-SNE
+    if (pca_dim is not None):
+        data_array, _ = pca_reduce(data_array, pca_dim, cache_file=pca_cache)
+
+    # apply t-SNE (or another embedding backend) on data
+    data2d = embed(data_array, backend=backend, reduced_dim=reduced_dim,
+                    perplexity=perplexity, n_jobs=n_jobs, seed=seed)
 
     # apply kmeans and save its labels for colorization
-    kmeans = KMeans(n_clusters=n_kmeans_clusters)
-    kmeans.fit(data2d)
+    kmeans = fit_clusters(data2d, n_clusters=n_kmeans_clusters, seed=seed)
     labels = kmeans.labels_
 
-    # create list of labels, which will be displayed when clicking
-    # on a datapoint
-    text_list = [create_label_for_matplotlib(main_df.loc[counter])      \
-    for counter in range(n_channels)]
-
     # plot
-    plt.figure("Interactive Plot", figsize=(20,10))
+    fig = plt.figure("Interactive Plot", figsize=(20,10))
+    ax = plt.gca()
     plt.title("Interactive Plot of Channels, click on Datapoints for Info")
 
     # for assigning different colors to different clusters
-    nr_to_color = ["b", "g", "r", "c", "y", "m", "k", "fuchsia",        \
-                    "gray", "navy", "coral"]
+    nr_to_color = cluster_palette(n_kmeans_clusters)
 
-    # plot every datapoint with its corresponding text ("label")
-    # dont iterative, to assign labels correctly
-    for dp in range(n_channels):
-        plt.scatter(data2d[dp,0], data2d[dp,1], linewidths=0.1,         \
-        c=nr_to_color[labels[dp]], label=text_list[dp])
+    # plot all datapoints, one collection per cluster
+    colors = [nr_to_color[cluster] for cluster in labels]
+    scatter_by_color(ax, data2d[:,0], data2d[:,1], colors)
 
-    # add datacursor, basically enabling "clickability" of datapoints
-    datacursor(formatter='{label}'.format, bbox=dict(fc='white'),       \
-                 arrowprops=dict(arrowstyle='simple', fc='black', alpha=0.5))
+    # enable "clickability" of datapoints; the label (text displayed when
+    # clicking on a datapoint) is only created for the clicked one
+    enable_point_info(fig, ax, LabelRenderer(main_df))
 
     plt.show()
     return 0
 
-def create_label_for_matplotlib(series_of_dp):
-    label = PrettyTable(["Attribute", "Value"])
-    exclude = ["Conc_Trace", "Temperature"]
-    for attribute in series_of_dp.keys():
-        if (attribute not in exclude):
-            label.add_row([attribute, series_of_dp[attribute]])
-
-
-    return str(label)
-
 if (__name__=="__main__"):
 
     # number of dimensions the data was reduced too in the paper
     # corresponding to the ion
-    ion_dim = {"K":16, "Na":21, "Ca":29, "IH":16, "KCa":16}
+    ion_dim = ION_DIM
 
     # Get traces
-    file_name = "Na_family_dataframe.pickle"
-    """
-    with open(file_name, 'r') as f:
-        channel_dict = json.load(f)
-    """
-
-    main_df = pd.read_pickle(file_name)
-    pp_channel_dict = dim_reduction(main_df)
+    store_prefix = "Na_family"
+    # (e.g. to_dataframe(protocols=["Inactivation", "Activation"]) to only
+    # embed those protocols)
+    main_df = TraceStore(store_prefix).to_dataframe()
+    pp_channel_dict = dim_reduction(main_df, pca_dim=ion_dim["Na"],
+                                    pca_cache="Na_family_pca.pickle")
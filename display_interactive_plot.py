@@ -1,16 +1,91 @@
+import os
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import operator
-from mpldatacursor import datacursor
-from bokeh.plotting import figure, output_file, show
+from bokeh.plotting import figure, output_file, show, save
+from bokeh.models import ColumnDataSource
+from trace_store import load_metadata
+from attribute_stats import attribute_statistics
+from metadata_index import MetadataIndex, index_file_name
+from point_labels import LabelRenderer
+from clustering import cluster_palette
+from instrumentation import stage
 
-def interactive_plot_plt(file_name):
+
+
+def cluster_to_color(clusters):
+    """
+    Converts an array of cluster numbers into an array of colors, for any
+    number of clusters.
+    """
+    clusters = np.asarray(clusters)
+    palette = cluster_palette(int(clusters.max()) + 1 if len(clusters) else 0)
+    return np.asarray(palette)[clusters]
+
+
+def scatter_by_color(ax, x, y, colors, rasterized=False):
+    """
+    Definition:
+        Plots all datapoints with one vectorized scatter collection per
+        color (i.e. per cluster), instead of one collection per datapoint.
+        Every collection remembers the rows of its datapoints, so picked
+        points can be mapped back to the rows of the dataframe.
+
+    Outputs:
+        collections (list): the scatter collections, each with an
+                            attribute 'rows'
+    """
+    colors = np.asarray(colors)
+    collections = []
+    for color in np.unique(colors):
+        rows = np.flatnonzero(colors == color)
+        collection = ax.scatter(x[rows], y[rows], linewidths=0.1, c=color,
+                                picker=True, rasterized=rasterized)
+        collection.rows = rows
+        collections.append(collection)
+
+    return collections
+
+
+
+def enable_point_info(fig, ax, label_for_row):
+    """
+    Definition:
+        Makes the datapoints clickable: a click on a datapoint shows the
+        label returned by label_for_row(row) in a box next to it. Labels are
+        only looked up for clicked points.
+    """
+    annotation = ax.annotate("", xy=(0, 0), xytext=(20, 20),
+                    textcoords="offset points", family="monospace",
+                    bbox=dict(fc='white'),
+                    arrowprops=dict(arrowstyle='simple', fc='black',
+                                    alpha=0.5))
+    annotation.set_visible(False)
+
+    def on_pick(event):
+        rows = getattr(event.artist, "rows", None)
+        if (rows is None or len(event.ind) == 0):
+            return
+        position = event.ind[0]
+        annotation.xy = event.artist.get_offsets()[position]
+        annotation.set_text(label_for_row(rows[position]))
+        annotation.set_visible(True)
+        fig.canvas.draw_idle()
+
+    fig.canvas.mpl_connect("pick_event", on_pick)
+    return annotation
+
+
+
+def interactive_plot_plt(file_name, meta_name, rasterize_above=100000):
     """
     Defintion:
         Function which plots all datapoints of a beforehand finished channel
         selection.
         Additionally, the plot is interactive in that regard, that you will be
         able click on the datapoints in the resulting plot for more information
+        (created from the metadata of the trace store meta_name when clicked).
+        Above rasterize_above datapoints the collections are rasterized.
     """
 
     # get plot values from beforehand created pickle
@@ -18,50 +93,74 @@ def interactive_plot_plt(file_name):
 
     # plot
     fig = plt.figure("Interactive Plot", figsize=(20,10))
+    ax = plt.gca()
     plt.title("Interactive Plot of Channels, click on Datapoints for Info")
 
-    # plot with all available information of the pickle file
-    for dp in range(len(df)):
-        plt.scatter(df['Value1'][dp], df['Value2'][dp], linewidths=0.1,         \
-        c=df['Color'][dp], label=df['Label'][dp])
+    # plot with all available information of the pickle file, one collection
+    # per cluster color
+    scatter_by_color(ax, df['Value1'].to_numpy(), df['Value2'].to_numpy(),
+                        cluster_to_color(df['Cluster']),
+                        rasterized=len(df) > rasterize_above)
 
-    # add datacursor, basically enabling "clickability" of datapoints
-    datacursor(formatter='{label}'.format, bbox=dict(fc='white'),       \
-                 arrowprops=dict(arrowstyle='simple', fc='black', alpha=0.5))
+    # enable "clickability" of datapoints, labels are created by row
+    enable_point_info(fig, ax, LabelRenderer(load_metadata(meta_name)))
 
     plt.show()
 
 
 
+def interactive_plot_datashader(file_name, out_file="cgi_channels.png",
+                                width=1200, height=800):
+    """
+    Defintion:
+        Renders the datapoints of a channel selection as one raster image with
+        datashader, colored by cluster. Meant for maps too big for
+        interactive scatter plots; needs the optional datashader package.
+    """
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    from matplotlib.colors import to_hex
+
+    df = pd.read_pickle(file_name)
+    df['Color'] = pd.Categorical(cluster_to_color(df['Cluster']))
+    color_key = {color: to_hex(color) for color in df['Color'].cat.categories}
+
+    canvas = ds.Canvas(plot_width=width, plot_height=height)
+    aggregate = canvas.points(df, 'Value1', 'Value2', agg=ds.count_cat('Color'))
+    image = tf.dynspread(tf.shade(aggregate, color_key=color_key, how='eq_hist'))
+    image.to_pil().save(out_file)
+
+    print("[+] Saved raster of", len(df), "channels in:", out_file)
+
+
+
 def mscatter_basic(p, x, y):
     """
     Definition:
-        Takes a bekoh plot object and 2 values (coordinates) and plots black
-        circles at the according position on the plot object
+        Takes a bekoh plot object and 2 coordinate arrays and plots black
+        circles at the according positions, all in one glyph
     """
-    p.scatter(x, y, marker='circle', size=7,
+    source = ColumnDataSource(data=dict(x=x, y=y))
+    p.scatter('x', 'y', source=source, marker='circle', size=7,
             line_color="black", fill_color="black")
 
 
 
-def mscatter(p, x, y, allowed, value_list):
+def mscatter(p, x, y, legend_label):
     """
     Definition:
-        Takes a bekoh plot object and 2 values (coordinates), a dictionary of
-        allowed values, and a value list.
-        It first checks which values the datapoint (x,y) has and whether they
-        are in the dictionary of allowed values.
-        In case they are, a red circle is plotted.
+        Takes a bekoh plot object and 2 coordinate arrays of all datapoints
+        having one particular attribute value, and plots red circles at
+        their positions, all in one glyph with one legend entry
     """
-    for value in value_list:
-        if value in allowed.keys():
-            p.scatter(x, y, marker='circle', size=6.5,
-                    line_color="red", fill_color="red", legend=allowed[value])
-
+    source = ColumnDataSource(data=dict(x=x, y=y))
+    p.scatter('x', 'y', source=source, marker='circle', size=6.5,
+            line_color="red", fill_color="red", legend_label=legend_label)
 
 
 
-def interactive_plot_bokeh(file_name, meta_name, attribute="Animal_Model"):
+def interactive_plot_bokeh(file_name, meta_name, attribute="Animal_Model",
+                            out_file=None, open_browser=True, stats=None):
     """
     Defintion:
         Creates a Bokeh plot in which it first plots a black dot for every
@@ -80,74 +179,80 @@ def interactive_plot_bokeh(file_name, meta_name, attribute="Animal_Model"):
             'Age',
             'Author'
             'Temperature'
+
+        The html is written to out_file (by default
+        "cgi_channels_interactive_<attribute>.html") and opened in a browser
+        unless open_browser is False.
+        The value statistics come from stats, by default the shared
+        AttributeStatistics of meta_name (see attribute_statistics), so
+        plotting another attribute of the same store reuses its cache.
     """
 
     #get plot values
     df = pd.read_pickle(file_name)
-    #get metadata
-    df_m = pd.read_pickle(meta_name)
+    #get metadata (only the sidecar of the trace store, not the traces)
+    if (stats is None):
+        stats = attribute_statistics(meta_name)
 
 
     # because I can only visualize 30 values in the legend, find the the top 30
     # values of an attribute
-    counting_dict = {}
     legend_allowed = {}
 
-    for i in range(len(df)):
-        value_list = df_m[attribute][i]
-        for value in value_list:
-            # if a value is not yet in our dictionary, add it with amount 1
-            if value not in counting_dict.keys():
-                counting_dict[value] = 1
-            else:
-                counting_dict[value] += 1
-
-    # sort them from small to large as tuples!
-    sorted_list = sorted(counting_dict.items(), key=operator.itemgetter(1))
-
-    # in case less than 30 unique values
-    try:
-        go_over = sorted_list[-30:]
-    else:
-        go_over = sorted_list
-
-    # go over all of the 30 most common tuple pairs
-    for tuple_val in go_over:
+    for value, amount in stats.top_values(attribute, k=30):
         # create a dictionary of form value:str(value (amount))
-        legend_allowed[tuple_val[0]] = tuple_val[0] + " (" + \
-            str(tuple_val[1]) + ")"
+        legend_allowed[value] = value + " (" + str(amount) + ")"
+
 
+    with stage("render", items=len(df), attribute=attribute):
+        # create bokeh plot
+        # (webgl renders the glyphs on the gpu, which keeps big maps
+        # responsive)
+        p = figure(width=1200, height=800, output_backend="webgl")
+        p.title.text = \
+            'Click on legend entries to mute the corresponding points'
 
-    # create bokeh plot
-    p = figure(plot_width=1200, plot_height=800)
-    p.title.text = 'Click on legend entries to mute the corresponding points'
+        # create one glyph of black circles for all points, and one glyph of
+        # red circles for every one of the chosen attribute values, covering
+        # all the points having this value
+        x = df['Value1'].to_numpy()
+        y = df['Value2'].to_numpy()
+        mscatter_basic(p, x, y)
+        # look the rows up in the persisted index, if the dump created one
+        if (os.path.exists(index_file_name(meta_name))):
+            index = MetadataIndex.load(meta_name)
+            rows_per_value = {value: index.rows(attribute, value) \
+                                for value in legend_allowed.keys()}
+        else:
+            rows_per_value = stats.rows_per_value(attribute)
+        for value, legend_label in legend_allowed.items():
+            rows = rows_per_value[value]
+            mscatter(p, x[rows], y[rows], legend_label)
 
-    # create one black circle. create one red circle for every point, for
-    # every value of the chosen attributes
-    for i in range(len(df)):
-        print(i)
-        mscatter_basic(p, df['Value1'][i], df['Value2'][i])
-        mscatter(p, df['Value1'][i], df['Value2'][i],
-            legend_allowed, df_m[attribute][i])
 
+        # define legend and action when click on a legend value
+        p.legend.location = "top_left"
+        p.legend.click_policy="hide"
 
-    # define legend and action when click on a legend value
-    p.legend.location = "top_left"
-    p.legend.click_policy="hide"
 
+        # save in interactive html
+        if (out_file is None):
+            out_file = "cgi_channels_interactive_" + attribute + ".html"
+        output_file(out_file, title="CGI Channels")
 
-    # save in interactive html
-    output_file("cgi_channels_interactive_" + attribute + ".html",
-        title="CGI Channels")
+        # open html in browser
+        if (open_browser):
+            show(p)
+        else:
+            save(p)
 
-    # open html in browser
-    show(p)
+    return out_file
 
 
 
 if (__name__=='__main__'):
     file_name = "Interactive_Plot_Values.pickle"
-    meta_name = "Na_family_dataframe.pickle"
+    meta_name = "Na_family"
 
-    #interactive_plot_plt(file_name)
+    #interactive_plot_plt(file_name, meta_name)
     interactive_plot_bokeh(file_name, meta_name)
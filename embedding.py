@@ -0,0 +1,118 @@
+import numpy as np
+
+from instrumentation import stage
+
+
+
+def embed_bhsne(data_array, reduced_dim=2, perplexity=30, n_jobs=1,
+                seed=None):
+    """
+    Barnes-Hut t-SNE of the `tsne` package (single threaded).
+    """
+    from tsne import bh_sne
+
+    kwargs = {} if seed is None else {"random_state": np.random.RandomState(seed)}
+    # bh_sne only works on float64
+    return bh_sne(np.asarray(data_array, dtype=np.float64), d=reduced_dim,
+                    perplexity=perplexity, **kwargs)
+
+
+
+def embed_sklearn(data_array, reduced_dim=2, perplexity=30, n_jobs=-1,
+                    seed=None):
+    """
+    Barnes-Hut t-SNE of scikit-learn, neighbour search on n_jobs cores.
+    """
+    from sklearn.manifold import TSNE
+
+    tsne = TSNE(n_components=reduced_dim, perplexity=perplexity, init="pca",
+                n_jobs=n_jobs, random_state=seed)
+    return tsne.fit_transform(data_array)
+
+
+
+def embed_opentsne(data_array, reduced_dim=2, perplexity=30, n_jobs=-1,
+                    seed=None):
+    """
+    openTSNE with FFT accelerated gradients, on n_jobs cores.
+    """
+    from openTSNE import TSNE
+
+    method = "fft" if reduced_dim <= 2 else "bh"
+    tsne = TSNE(n_components=reduced_dim, perplexity=perplexity,
+                negative_gradient_method=method, n_jobs=n_jobs,
+                random_state=seed)
+    return np.asarray(tsne.fit(np.asarray(data_array, dtype=np.float64)))
+
+
+
+def embed_umap(data_array, reduced_dim=2, perplexity=30, n_jobs=-1,
+                seed=None):
+    """
+    UMAP, with a neighbourhood of the size t-SNE effectively uses for the
+    given perplexity. Note that UMAP is only single threaded when seeded.
+    """
+    import umap
+
+    reducer = umap.UMAP(n_components=reduced_dim,
+                        n_neighbors=int(min(3*perplexity, len(data_array)-1)),
+                        n_jobs=n_jobs, random_state=seed)
+    return reducer.fit_transform(data_array)
+
+
+
+# name -> embedding function, all with the same signature and returning the
+# (n_channels x reduced_dim) array data2d
+EMBEDDING_BACKENDS = {"bhsne": embed_bhsne,
+                        "sklearn": embed_sklearn,
+                        "opentsne": embed_opentsne,
+                        "umap": embed_umap}
+
+# python modules each backend needs
+BACKEND_MODULES = {"bhsne": "tsne", "sklearn": "sklearn",
+                    "opentsne": "openTSNE", "umap": "umap"}
+
+
+
+def available_backends():
+    """
+    Returns the names of all backends whose package is installed.
+    """
+    import importlib.util
+
+    return [name for name, module in BACKEND_MODULES.items() \
+            if importlib.util.find_spec(module) is not None]
+
+
+
+def embed(data_array, backend="bhsne", reduced_dim=2, perplexity=30,
+            n_jobs=-1, seed=None):
+    """
+    Definition
+        Embeds the rows of data_array into reduced_dim dimensions with the
+        chosen backend.
+
+    Args:
+        data_array (np.ndarray): (n_channels x n_features) matrix
+        backend (str): one of EMBEDDING_BACKENDS
+        reduced_dim (int): dimensionality of the embedding
+        perplexity (float): perplexity of t-SNE (neighbourhood size of UMAP)
+        n_jobs (int): number of threads, -1 for all cores
+        seed (int): random seed, None for a random initialisation
+
+    Outputs:
+        data2d (np.ndarray): (n_channels x reduced_dim) embedding
+    """
+    if (backend not in EMBEDDING_BACKENDS):
+        raise ValueError("[!] Unknown embedding backend {}, choose one of \
+        {}!".format(backend, sorted(EMBEDDING_BACKENDS)))
+
+    try:
+        with stage("embed", items=len(data_array), backend=backend):
+            return EMBEDDING_BACKENDS[backend](data_array,
+                                                reduced_dim=reduced_dim,
+                                                perplexity=perplexity,
+                                                n_jobs=n_jobs, seed=seed)
+    except ImportError as error:
+        raise ImportError("[!] Embedding backend {} needs the package {} \
+        ({})".format(backend, BACKEND_MODULES[backend], error))
@@ -0,0 +1,138 @@
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from preprocessing import build_trace_matrix, zscore_columns
+
+
+
+class EmbeddingModel():
+    """
+    Definition
+        Everything needed to place new channels into an existing map without
+        refitting it: the normalization statistics, the PCA projection, the
+        (PCA reduced) inputs and 2-D coordinates of all embedded channels,
+        and the fitted KMeans.
+        A new trace is normalized and projected like the fitted ones, its
+        nearest embedded neighbours are found with a k-d tree over the
+        reduced inputs (O(log M) per query for M embedded channels), and it
+        is placed at the inverse distance weighted mean of their coordinates.
+        Its cluster is then KMeans.predict of that position.
+
+    Args:
+        ids (np.ndarray): channel ids of the embedded channels
+        mean, std (np.ndarray): column statistics of the Z-scoring
+        pca (PCA): fitted projection, None if no PCA was applied
+        reduced (np.ndarray): embedding inputs of the embedded channels
+        data2d (np.ndarray): their coordinates in the map
+        kmeans (KMeans): fitted clustering of the map
+        protocols (list): protocols of the trace store the map was embedded
+                            from (see TraceStore.select), None for all
+    """
+
+    def __init__(self, ids, mean, std, pca, reduced, data2d, kmeans,
+                    protocols=None):
+        self.ids = np.asarray(ids)
+        self.mean = mean
+        self.std = std
+        self.pca = pca
+        self.reduced = np.asarray(reduced)
+        self.data2d = np.asarray(data2d)
+        self.kmeans = kmeans
+        self.protocols = None if protocols is None else list(protocols)
+        self.clusters = kmeans.predict(self.data2d) if kmeans is not None \
+                        else np.zeros(len(self.ids), dtype=np.int32)
+        self._tree = None
+
+    def save(self, file_name):
+        tree, self._tree = self._tree, None
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            pickle.dump(self, f)
+        os.replace(tmp_name, file_name)
+        self._tree = tree
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, "rb") as f:
+            return pickle.load(f)
+
+    @property
+    def tree(self):
+        # built lazily, and again after channels were added
+        if (self._tree is None):
+            self._tree = cKDTree(self.reduced)
+        return self._tree
+
+    def transform_traces(self, traces):
+        """
+        Normalizes (with the stored statistics) and projects raw traces into
+        the space the map was embedded from.
+        """
+        data_array = build_trace_matrix(traces, dtype=np.float64)
+        if (data_array.ndim == 1):
+            data_array = data_array[np.newaxis]
+        if (data_array.shape[1] != len(self.mean)):
+            raise ValueError("[!] Traces have {} values, but the map was \
+            embedded from {} (protocols {})!".format(data_array.shape[1],
+                                                    len(self.mean),
+                                                    self.protocols or "all"))
+        data_array = zscore_columns(data_array, mean=self.mean, std=self.std)
+        if (self.pca is not None):
+            data_array = self.pca.transform(data_array)
+        return data_array
+
+    def project(self, traces, n_neighbors=10):
+        """
+        Definition
+            Places new traces into the map.
+
+        Args:
+            traces: raw traces, see build_trace_matrix
+            n_neighbors (int): number of embedded neighbours to average
+
+        Outputs:
+            reduced (np.ndarray): embedding inputs of the new traces
+            new2d (np.ndarray): their coordinates in the map
+            clusters (np.ndarray): their clusters
+        """
+        reduced = self.transform_traces(traces)
+        n_neighbors = min(n_neighbors, len(self.reduced))
+        distances, neighbors = self.tree.query(reduced, k=n_neighbors)
+        if (n_neighbors == 1):
+            distances = distances[:, np.newaxis]
+            neighbors = neighbors[:, np.newaxis]
+
+        weights = 1. / np.maximum(distances, 1e-12)
+        weights /= weights.sum(axis=1, keepdims=True)
+        new2d = (weights[:, :, np.newaxis] * self.data2d[neighbors]).sum(axis=1)
+        # KMeans.predict expects the dtype it was fitted on
+        new2d = new2d.astype(self.data2d.dtype)
+
+        clusters = self.kmeans.predict(new2d) if self.kmeans is not None \
+                    else np.zeros(len(new2d), dtype=np.int32)
+        return reduced, new2d, clusters
+
+    def add(self, ids, traces, n_neighbors=10):
+        """
+        Projects new channels and adds them to the model, so they serve as
+        neighbours of later ones. Returns their coordinates and clusters.
+        """
+        reduced, new2d, clusters = self.project(traces, n_neighbors)
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids)])
+        self.reduced = np.vstack([self.reduced, reduced])
+        self.data2d = np.vstack([self.data2d, new2d])
+        self.clusters = np.concatenate([self.clusters, clusters])
+        self._tree = None
+
+        return new2d, clusters
+
+    def rows_of(self, ids):
+        """
+        Returns the model rows of the given ids, -1 for unknown ids.
+        """
+        position = {_id: row for row, _id in enumerate(self.ids.tolist())}
+        return np.array([position.get(_id, -1) for _id in ids], dtype=np.int64)
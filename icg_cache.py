@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+
+
+class CachedResponse():
+    """
+    Definition
+        Minimal stand-in for a requests.Response, served from the cache. It
+        offers the attributes the getters use (status_code, content,
+        headers).
+    """
+
+    def __init__(self, status_code, content, headers=None, from_cache=True):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+        self.from_cache = from_cache
+
+
+
+class ResponseCache():
+    """
+    Definition
+        Persistent http response cache keyed by url. It can be handed to
+        channel_id_getter, trace_getter, metadata_getter and the ICGHarvester
+        in place of a requests.Session.
+        Entries younger than `ttl` are served from disk directly. Older ones
+        are revalidated with If-None-Match / If-Modified-Since, so an
+        unchanged resource only costs a 304 without body. The cache is
+        bounded to `max_bytes`, evicting the least recently used entries.
+        In offline mode everything is served from disk, whatever its age,
+        and a miss raises a ValueError.
+
+    Args:
+        cache_dir (str): directory of the cache, created if necessary
+        session (requests.Session): session for the actual requests,
+                                    defaults to the plain requests module
+        ttl (float): seconds an entry is used without revalidation
+        max_bytes (int): upper bound for the size of all cached bodies
+        offline (bool): never touch the network
+    """
+
+    def __init__(self, cache_dir="icg_cache", session=requests, ttl=24*3600.,
+                    max_bytes=2*1024**3, offline=False):
+        self.cache_dir = cache_dir
+        self.session = session
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> [body size, last access], rebuilt from the files on disk.
+        # The last access is kept as the atime of the body file, which is
+        # set explicitly on every hit (independent of the mount options)
+        self.index = {}
+        for file_name in os.listdir(cache_dir):
+            if (file_name.endswith(".body")):
+                stat = os.stat(os.path.join(cache_dir, file_name))
+                self.index[file_name[:-5]] = [stat.st_size, stat.st_atime]
+        self.total_bytes = sum(size for size, _ in self.index.values())
+
+    def close(self):
+        if (hasattr(self.session, "close")):
+            self.session.close()
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf8")).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return key, base + ".body", base + ".meta"
+
+    def _load_meta(self, meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_atomic(self, path, data, mode="wb"):
+        # write to a temporary file first, so a crash never leaves a
+        # half written entry behind
+        tmp_path = path + ".tmp." + str(threading.get_ident())
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _touch(self, key, body_path):
+        now = time.time()
+        try:
+            os.utime(body_path, (now, os.stat(body_path).st_mtime))
+        except OSError:
+            pass
+        with self.lock:
+            if (key in self.index):
+                self.index[key][1] = now
+
+    def _read(self, key, body_path, meta):
+        try:
+            with open(body_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        self._touch(key, body_path)
+        return CachedResponse(200, content, meta.get("headers", {}))
+
+    def _store(self, url, response):
+        key, body_path, meta_path = self._paths(url)
+        content = response.content
+        headers = {name: response.headers[name] for name in \
+                    ("ETag", "Last-Modified") if name in response.headers}
+        meta = {"url": url, "stored_at": time.time(), "headers": headers}
+
+        self._write_atomic(body_path, content)
+        self._write_atomic(meta_path, json.dumps(meta), mode="w")
+
+        with self.lock:
+            old_size = self.index.get(key, [0, 0])[0]
+            self.index[key] = [len(content), time.time()]
+            self.total_bytes += len(content) - old_size
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes least recently used entries until the cache fits max_bytes.
+        """
+        with self.lock:
+            if (self.total_bytes <= self.max_bytes):
+                return
+            by_age = sorted(self.index.items(), key=lambda item: item[1][1])
+            victims = []
+            for key, (size, _) in by_age:
+                if (self.total_bytes <= self.max_bytes):
+                    break
+                victims.append(key)
+                self.total_bytes -= size
+                del self.index[key]
+
+        for key in victims:
+            base = os.path.join(self.cache_dir, key)
+            for path in (base + ".body", base + ".meta"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def is_fresh(self, url):
+        """
+        Returns whether a get of the url will be answered without touching
+        the network.
+        """
+        key, _, meta_path = self._paths(url)
+        if (key not in self.index):
+            return False
+        if (self.offline):
+            return True
+        meta = self._load_meta(meta_path)
+        return meta is not None and time.time() - meta["stored_at"] < self.ttl
+
+    def get(self, url, **kwargs):
+        """
+        Definition
+            Same signature as requests.get. Returns a cached response if
+            possible, revalidates stale entries and stores new 200 responses.
+        """
+        key, body_path, meta_path = self._paths(url)
+        meta = self._load_meta(meta_path) if key in self.index else None
+
+        if (meta is not None):
+            if (self.offline or time.time() - meta["stored_at"] < self.ttl):
+                cached = self._read(key, body_path, meta)
+                if (cached is not None):
+                    return cached
+
+        if (self.offline):
+            raise ValueError("[!] {} is not cached and the cache is in \
+            offline mode!".format(url))
+
+        # ask the server whether our copy is still valid
+        headers = dict(kwargs.pop("headers", None) or {})
+        if (meta is not None):
+            if ("ETag" in meta["headers"]):
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if ("Last-Modified" in meta["headers"]):
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+
+        response = self.session.get(url, headers=headers, **kwargs)
+
+        if (response.status_code == 304 and meta is not None):
+            # unchanged, so only renew the age of the entry
+            meta["stored_at"] = time.time()
+            self._write_atomic(meta_path, json.dumps(meta), mode="w")
+            cached = self._read(key, body_path, meta)
+            if (cached is not None):
+                return cached
+            # body vanished in the meantime (evicted), so fetch it again
+            response = self.session.get(url, **kwargs)
+
+        if (response.status_code == 200):
+            self._store(url, response)
+
+        return response
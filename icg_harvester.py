@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from data_extraction_processing import ICG_API_URL, TRACE_NAMES, trace_url, \
+    metadata_url, family_url, response_to_json, parse_trace_dict, \
+    parse_metadata, parse_channel_ids
+from instrumentation import METRICS, timed_get
+
+# status codes for which it is pointless to ask again
+NO_RETRY_STATUS = (400, 401, 403, 404, 410)
+
+
+
+def pooled_session(pool_size=8):
+    """
+    Returns a requests.Session with one connection pool slot per worker, so
+    connections get reused instead of being opened anew for every request.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+
+class HostRateLimiter():
+    """
+    Definition
+        Thread safe limiter, which spaces out requests to the same host so
+        that at most `requests_per_second` of them are started per second.
+        A value of None (or <= 0) disables the limiting.
+    """
+
+    def __init__(self, requests_per_second=10.):
+        self.interval = 0. if not requests_per_second \
+                            else 1. / requests_per_second
+        self.lock = threading.Lock()
+        # host -> earliest time the next request may be started
+        self.next_slot = {}
+
+    def wait(self, url):
+        if (self.interval <= 0.):
+            return
+
+        host = urlsplit(url).netloc
+        # reserve a slot under the lock, but sleep outside of it
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+
+        if (slot > now):
+            time.sleep(slot - now)
+
+
+
+class ICGHarvester():
+    """
+    Definition
+        Concurrent fetch engine for the icg api. All requests go through one
+        shared, pooled requests.Session and are spread over a bounded thread
+        pool. Metadata and trace of a channel are fetched together, requests
+        to a host are rate limited and responses which are not 200 are
+        retried with exponential backoff.
+
+    Args:
+        base_url (str): base url of the icg api, point it to a local stand-in
+                        server for testing
+        max_workers (int): number of concurrently fetched channels
+        requests_per_second (float): maximal request rate per host
+        max_retries (int): retries per request before giving up
+        backoff (float): base delay of the exponential backoff in seconds
+        timeout (float): timeout of a single request in seconds
+        session (requests.Session): session to use (e.g. a ResponseCache),
+                                    a pooled one is created if none is given
+        protocols (list): traces to fetch, by default all of TRACE_NAMES
+    """
+
+    def __init__(self, base_url=ICG_API_URL, max_workers=8,
+                    requests_per_second=10., max_retries=5, backoff=0.5,
+                    timeout=30., session=None, protocols=TRACE_NAMES):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.protocols = list(protocols)
+        self.limiter = HostRateLimiter(requests_per_second)
+
+        if (session is None):
+            session = pooled_session(max_workers)
+        self.session = session
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_json(self, url, endpoint="other"):
+        """
+        Definition
+            Gets the url and decodes its json body. Connection errors and
+            responses which are not 200 are retried with exponential backoff
+            (respecting a Retry-After header), up to max_retries times.
+            Latency and status of every attempt, and the retries, are
+            recorded under the given endpoint label (see instrumentation).
+        """
+        # answers coming from a response cache do not load the server
+        is_fresh = getattr(self.session, "is_fresh", None)
+
+        for attempt in range(self.max_retries + 1):
+            if (is_fresh is None or not is_fresh(url)):
+                self.limiter.wait(url)
+            delay = self.backoff * 2**attempt
+            try:
+                response = timed_get(self.session, url, endpoint=endpoint,
+                                        timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if (attempt == self.max_retries):
+                    raise
+                print("[!] Retrying {} after {}".format(url, error))
+                METRICS.inc("http_retries_total", endpoint=endpoint)
+                time.sleep(delay)
+                continue
+
+            if (response.status_code == 200):
+                return response_to_json(response)
+            if (response.status_code in NO_RETRY_STATUS or \
+                    attempt == self.max_retries):
+                # raises the usual ValueError of the getters
+                return response_to_json(response)
+
+            METRICS.inc("http_retries_total", endpoint=endpoint)
+            retry_after = response.headers.get("Retry-After", "")
+            if (retry_after.isdigit()):
+                delay = max(delay, float(retry_after))
+            time.sleep(delay)
+
+    def fetch_channel_ids(self, family_id):
+        """
+        Returns the list of channel ids of a family.
+        """
+        return parse_channel_ids(self.get_json(family_url(family_id,
+                                                            self.base_url),
+                                                endpoint="family"))
+
+    def fetch_channel(self, channel_id):
+        """
+        Returns a tuple (channel_id, metadata attribute list, dictionary
+        protocol:trace list) of one channel.
+        """
+        meta = parse_metadata(self.get_json(metadata_url(channel_id,
+                                                            self.base_url),
+                                            endpoint="metadata"))
+        trace = parse_trace_dict(self.get_json(trace_url(channel_id,
+                                                            self.base_url),
+                                                endpoint="trace"),
+                                    self.protocols)
+        return channel_id, meta, trace
+
+    def harvest(self, id_list, progress_every=100):
+        """
+        Definition
+            Fetches metadata and trace of all given channel ids concurrently.
+            Only a bounded number of channels is in flight at any time, so
+            memory stays flat for big families.
+
+        Args:
+            id_list (list): channel ids to fetch
+            progress_every (int): print progress every that many channels,
+                                    0 disables it
+
+        Outputs:
+            generator of (channel_id, metadata, trace) tuples, in order of
+            completion
+        """
+        pending_ids = deque(id_list)
+        n_total = len(pending_ids)
+        n_done = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            in_flight = set()
+            while (pending_ids or in_flight):
+                # keep the pool busy, but never queue up the whole family
+                while (pending_ids and len(in_flight) < 2*self.max_workers):
+                    in_flight.add(pool.submit(self.fetch_channel,
+                                                pending_ids.popleft()))
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if (progress_every and n_done % progress_every == 0):
+                        print(n_done, "of", n_total)
+                    n_done += 1
+                    yield future.result()
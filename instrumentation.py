@@ -0,0 +1,306 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is then not reported
+    resource = None
+
+# upper bounds (in seconds) of the http latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process so far in MB, None if
+    it cannot be determined.
+    """
+    if (resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024.**2 if sys.platform == "darwin" else 1024.)
+
+
+
+class Histogram():
+    """
+    Cumulative histogram of observed values, in the layout of a prometheus
+    histogram (counts of values <= each bucket bound, plus sum and count).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if (value <= bound):
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {"buckets": dict(zip(map(str, self.buckets), self.counts)),
+                "count": self.count, "sum": self.sum}
+
+
+
+class Metrics():
+    """
+    Definition
+        Thread safe registry of counters, histograms and stage records of
+        one process. Stage records (wall and cpu time, peak rss, items per
+        second) are additionally written as json lines to jsonl_file as soon
+        as a stage finishes; everything can be dumped in prometheus text
+        format with prometheus_text.
+        Optionally every stage is run under cProfile (its stats saved as
+        "<profile_dir>/<stage>-<pid>.prof") and/or tracemalloc, which adds the
+        peak of the python heap during the stage to its record.
+
+    Args:
+        jsonl_file (str): file the stage records are appended to, None only
+                            keeps them in memory
+        profile_dir (str): directory of the cProfile stats, None disables
+                            profiling
+        trace_memory (bool): trace python allocations with tracemalloc
+    """
+
+    def __init__(self, jsonl_file=None, profile_dir=None, trace_memory=False):
+        self.lock = threading.Lock()
+        self.profiling = False
+        # peaks of the enclosing traced stages, see stage
+        self.peak_stack = []
+        self.counters = {}
+        self.histograms = {}
+        self.stages = []
+        self.configure(jsonl_file, profile_dir, trace_memory)
+
+    def configure(self, jsonl_file=None, profile_dir=None, trace_memory=False):
+        self.jsonl_file = jsonl_file
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.stages = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if (key not in self.histograms):
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def observe_request(self, endpoint, seconds, status):
+        """
+        Records the latency and status of one http request.
+        """
+        self.observe("http_request_seconds", seconds, endpoint=endpoint)
+        self.inc("http_requests_total", endpoint=endpoint, status=str(status))
+
+    def emit(self, record):
+        if (self.jsonl_file is not None):
+            with self.lock:
+                with open(self.jsonl_file, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, name, items=None, **labels):
+        """
+        Definition
+            Measures the enclosed block as the stage name. items (e.g. the
+            number of channels) gives the throughput; it can also be set
+            later through the yielded record, record["items"] = n.
+
+        Outputs:
+            record (dict): stage record, filled in when the block exits
+        """
+        record = {"stage": name, "labels": labels, "items": items,
+                    "pid": os.getpid()}
+        profiler = None
+        # only one profiler can be active, nested stages are part of the
+        # profile of the outermost one
+        if (self.profile_dir is not None and not self.profiling):
+            profiler = cProfile.Profile()
+            self.profiling = True
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if (started_tracing):
+            tracemalloc.start()
+        elif (self.trace_memory):
+            # tracemalloc has only one peak: the peak reached so far is
+            # kept for the enclosing stage before it is reset for this one
+            with self.lock:
+                if (self.peak_stack):
+                    self.peak_stack[-1] = max(self.peak_stack[-1],
+                                            tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+        if (self.trace_memory):
+            with self.lock:
+                self.peak_stack.append(0)
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        if (profiler is not None):
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if (profiler is not None):
+                profiler.disable()
+                self.profiling = False
+            record["wall_seconds"] = time.perf_counter() - wall
+            # cpu time of all threads of the process, so it can exceed the
+            # wall time of multithreaded stages
+            record["cpu_seconds"] = time.process_time() - cpu
+            record["peak_rss_mb"] = peak_rss_mb()
+            if (self.trace_memory):
+                with self.lock:
+                    peak = max(self.peak_stack.pop(),
+                                tracemalloc.get_traced_memory()[1])
+                    # the peak of a nested stage is a peak of its parent too
+                    if (self.peak_stack):
+                        self.peak_stack[-1] = max(self.peak_stack[-1], peak)
+                record["peak_traced_mb"] = peak / 1024.**2
+                if (started_tracing):
+                    tracemalloc.stop()
+            if (record["items"] and record["wall_seconds"] > 0):
+                record["items_per_second"] = record["items"] / \
+                                                record["wall_seconds"]
+            record["time"] = time.time()
+
+            if (profiler is not None):
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir,
+                                    "{}-{}.prof".format(name, os.getpid())))
+            with self.lock:
+                self.stages.append(record)
+            self.emit(record)
+
+    def prometheus_text(self):
+        """
+        Returns all metrics in the prometheus text exposition format.
+        """
+        def label_text(labels):
+            if (not labels):
+                return ""
+            return "{" + ",".join('{}="{}"'.format(key, value) for \
+                                    key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("icg_{}{} {}".format(name, label_text(labels),
+                                                    value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append("icg_{}_bucket{} {}".format(name,
+                                label_text(labels + (("le", bound),)), count))
+                lines.append("icg_{}_bucket{} {}".format(name,
+                            label_text(labels + (("le", "+Inf"),)),
+                            histogram.count))
+                lines.append("icg_{}_sum{} {}".format(name, label_text(labels),
+                                                        histogram.sum))
+                lines.append("icg_{}_count{} {}".format(name,
+                                                        label_text(labels),
+                                                        histogram.count))
+            for record in self.stages:
+                labels = (("stage", record["stage"]),) + \
+                            tuple(sorted(record["labels"].items()))
+                for field in ("wall_seconds", "cpu_seconds", "peak_rss_mb",
+                                "peak_traced_mb", "items_per_second"):
+                    if (record.get(field) is not None):
+                        lines.append("icg_stage_{}{} {}".format(field,
+                                        label_text(labels), record[field]))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns counters, histograms and stage records as one json-able
+        dictionary.
+        """
+        with self.lock:
+            return {"counters": [{"name": name, "labels": dict(labels),
+                                    "value": value} for (name, labels), value \
+                                    in sorted(self.counters.items())],
+                    "histograms": [dict(histogram.to_dict(), name=name,
+                                        labels=dict(labels)) for \
+                                    (name, labels), histogram in \
+                                    sorted(self.histograms.items())],
+                    "stages": list(self.stages)}
+
+    def emit_totals(self, **labels):
+        """
+        Writes the current counters and histograms to jsonl_file, e.g. at the
+        end of a worker process whose registry is not seen by the parent.
+        """
+        summary = self.summary()
+        for record in summary["counters"] + summary["histograms"]:
+            self.emit(dict(record, pid=os.getpid(), totals=labels))
+
+    def dump(self, file_name, format="jsonl"):
+        """
+        Writes all metrics to file_name, as one json line per stage followed
+        by the counters and histograms ("jsonl"), or in prometheus text
+        format ("prometheus").
+        """
+        if (format == "prometheus"):
+            text = self.prometheus_text()
+        elif (format == "jsonl"):
+            summary = self.summary()
+            text = "".join(json.dumps(record) + "\n" for record in \
+                            summary["stages"] + summary["counters"] + \
+                            summary["histograms"])
+        else:
+            raise ValueError("[!] Unknown metrics format {}!".format(format))
+        with open(file_name, "w") as f:
+            f.write(text)
+
+
+
+# registry of the process; configured from the environment, so e.g. worker
+# processes of the pipeline report into the same file
+METRICS = Metrics(jsonl_file=os.environ.get("ICG_METRICS_FILE"),
+                    profile_dir=os.environ.get("ICG_PROFILE_DIR"),
+                    trace_memory=bool(os.environ.get("ICG_TRACEMALLOC")))
+
+
+
+def stage(name, items=None, **labels):
+    """
+    Shorthand for METRICS.stage, see Metrics.stage.
+    """
+    return METRICS.stage(name, items=items, **labels)
+
+
+
+def timed_get(session, url, endpoint="other", **kwargs):
+    """
+    Gets the url with the session and records latency and status of the
+    request (status "error" for connection errors and timeouts).
+    """
+    start = time.perf_counter()
+    try:
+        response = session.get(url, **kwargs)
+    except Exception:
+        METRICS.observe_request(endpoint, time.perf_counter() - start, "error")
+        raise
+    METRICS.observe_request(endpoint, time.perf_counter() - start,
+                            response.status_code)
+    return response
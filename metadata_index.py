@@ -0,0 +1,141 @@
+import json
+import os
+from functools import reduce
+
+import numpy as np
+
+from attribute_stats import AttributeStatistics, ATTRIBUTES
+
+
+
+def index_file_name(prefix):
+    """
+    Returns the name of the metadata index next to the trace store with the
+    given prefix (e.g. "Na_family").
+    """
+    return prefix + "_index.npz"
+
+
+
+class MetadataIndex():
+    """
+    Definition
+        Inverted index from every (attribute, value) pair of the metadata to
+        the sorted rows (int32) of the channels having this value. All row
+        lists are kept in one concatenated array with offsets, so a lookup
+        is a dictionary access plus a slice. AND / OR queries across
+        attributes intersect / unite the sorted row arrays.
+
+    Args:
+        keys (list): (attribute, value) pairs
+        offsets (np.ndarray): start of the rows of key i in postings, with
+                                a final entry for the end
+        postings (np.ndarray): concatenated sorted row arrays
+        n_rows (int): number of channels
+    """
+
+    def __init__(self, keys, offsets, postings, n_rows):
+        self.keys = [tuple(key) for key in keys]
+        self.position = {key: i for i, key in enumerate(self.keys)}
+        self.offsets = offsets
+        self.postings = postings
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, meta_df, attributes=ATTRIBUTES):
+        """
+        Builds the index over the given list-valued metadata columns.
+        """
+        stats = AttributeStatistics(meta_df)
+        keys = []
+        row_arrays = []
+        for attribute in attributes:
+            for value, rows in sorted(stats.rows_per_value(attribute).items()):
+                keys.append((attribute, value))
+                row_arrays.append(rows.astype(np.int32))
+
+        offsets = np.zeros(len(row_arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(rows) for rows in row_arrays])
+        postings = np.concatenate(row_arrays) if row_arrays \
+                    else np.zeros(0, dtype=np.int32)
+
+        return cls(keys, offsets, postings, len(meta_df))
+
+    def save(self, prefix):
+        """
+        Persists the index next to the trace store with the given prefix.
+        """
+        file_name = index_file_name(prefix)
+        tmp_name = file_name + ".tmp.npz"
+        np.savez(tmp_name, offsets=self.offsets, postings=self.postings,
+                    n_rows=np.int64(self.n_rows),
+                    keys=np.array(json.dumps(self.keys)))
+        os.replace(tmp_name, file_name)
+        return file_name
+
+    @classmethod
+    def load(cls, prefix):
+        with np.load(index_file_name(prefix)) as data:
+            return cls(json.loads(str(data["keys"])), data["offsets"],
+                        data["postings"], int(data["n_rows"]))
+
+    def values(self, attribute):
+        """
+        Returns all indexed values of an attribute.
+        """
+        return [value for key_attribute, value in self.keys \
+                if key_attribute == attribute]
+
+    def count(self, attribute, value):
+        """
+        Returns the number of channels having the value.
+        """
+        i = self.position.get((attribute, value))
+        return 0 if i is None else int(self.offsets[i+1] - self.offsets[i])
+
+    def rows(self, attribute, value):
+        """
+        Returns the sorted rows of the channels having the value (a view).
+        """
+        i = self.position.get((attribute, value))
+        if (i is None):
+            return np.zeros(0, dtype=np.int32)
+        return self.postings[self.offsets[i]:self.offsets[i+1]]
+
+    def query_and(self, *pairs):
+        """
+        Rows having all of the given (attribute, value) pairs.
+        """
+        row_arrays = sorted((self.rows(*pair) for pair in pairs), key=len)
+        if (not row_arrays):
+            return np.arange(self.n_rows, dtype=np.int32)
+        # start with the shortest list, so intersections stay small
+        return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True),
+                        row_arrays)
+
+    def query_or(self, *pairs):
+        """
+        Rows having at least one of the given (attribute, value) pairs.
+        """
+        if (not pairs):
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.rows(*pair) for pair in pairs]))
+
+    def query(self, **conditions):
+        """
+        Definition
+            Conjunction over attributes of disjunctions over values, e.g.
+            query(Brain_Area=["Hippocampus", "Cortex"], Animal_Model="Rat")
+            returns the rows of rat channels from hippocampus or cortex.
+        """
+        row_arrays = []
+        for attribute, values in conditions.items():
+            if (isinstance(values, str)):
+                values = [values]
+            row_arrays.append(self.query_or(*[(attribute, value) \
+                                                for value in values]))
+        row_arrays.sort(key=len)
+        if (not row_arrays):
+            return np.arange(self.n_rows, dtype=np.int32)
+        return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True),
+                        row_arrays)
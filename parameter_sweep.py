@@ -0,0 +1,135 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+from sklearn.manifold import TSNE
+from sklearn.metrics import silhouette_score
+from sklearn.neighbors import KNeighborsTransformer
+
+from trace_store import TraceStore
+from preprocessing import normalized_trace_matrix, pca_reduce
+
+
+
+def knn_graph(data_array, max_perplexity, n_jobs=-1):
+    """
+    Definition
+        Computes the sparse k nearest neighbour graph, with k large enough
+        for t-SNE with the largest perplexity of the sweep (3*perplexity+1
+        neighbours). The graph is built on the data itself, so every row
+        holds its own zero distance entry, which scikit-learn's t-SNE
+        expects to find and drop as the point itself. Smaller perplexities
+        pick their neighbours out of this graph, so the neighbour search
+        only runs once.
+
+    Outputs:
+        graph (scipy.sparse.csr_matrix): euclidean distances to the k
+                                            nearest neighbours of each row
+                                            (t-SNE squares them itself)
+    """
+    n_neighbors = min(data_array.shape[0] - 1, int(3*max_perplexity + 1))
+    return KNeighborsTransformer(n_neighbors=n_neighbors, mode="distance",
+                                    n_jobs=n_jobs).fit_transform(data_array)
+
+
+
+def sweep_perplexity(graph, perplexity, cluster_counts, out_dir, seed=0):
+    """
+    Definition
+        Worker of the sweep: one embedding for the given perplexity from the
+        precomputed graph, then one KMeans fit per cluster count. Every
+        result is saved as .npz (embedding and labels) in out_dir.
+
+    Outputs:
+        rows (list): one dict of parameters and quality metrics per fit
+    """
+    start = time.perf_counter()
+    tsne = TSNE(n_components=2, perplexity=perplexity, metric="precomputed",
+                init="random", random_state=seed, n_jobs=1)
+    data2d = tsne.fit_transform(graph)
+    embed_time = time.perf_counter() - start
+
+    rows = []
+    for n_kmeans_clusters in cluster_counts:
+        kmeans = KMeans(n_clusters=n_kmeans_clusters, n_init=10,
+                        random_state=seed)
+        labels = kmeans.fit_predict(data2d)
+
+        result_file = os.path.join(out_dir, "perplexity_{}_clusters_{}.npz" \
+                                    .format(perplexity, n_kmeans_clusters))
+        np.savez(result_file, data2d=data2d, labels=labels)
+
+        rows.append({"perplexity": perplexity,
+                        "n_kmeans_clusters": n_kmeans_clusters,
+                        "kl_divergence": tsne.kl_divergence_,
+                        "silhouette": silhouette_score(data2d, labels),
+                        "inertia": kmeans.inertia_,
+                        "embed_time": embed_time,
+                        "result_file": result_file})
+    return rows
+
+
+
+def parameter_sweep(data_array, perplexities, cluster_counts,
+                    out_dir="sweep_results", max_workers=None, seed=0):
+    """
+    Definition
+        Sweeps perplexity and n_kmeans_clusters: the kNN graph is computed
+        once for the largest perplexity, the embeddings (one per perplexity)
+        with their KMeans fits are fanned out over a process pool. The
+        results table is written to out_dir/results.csv.
+
+    Args:
+        data_array (np.ndarray): normalized (and possibly PCA reduced) traces
+        perplexities (list): perplexities to try
+        cluster_counts (list): numbers of KMeans clusters to try
+        out_dir (str): directory for the results
+        max_workers (int): number of worker processes, None for all cores
+        seed (int): seed of t-SNE and KMeans
+
+    Outputs:
+        results (pd.DataFrame): one row per (perplexity, n_kmeans_clusters)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    graph = knn_graph(data_array, max(perplexities))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(sweep_perplexity, graph, perplexity,
+                                cluster_counts, out_dir, seed) \
+                    for perplexity in perplexities]
+        for future in futures:
+            rows.extend(future.result())
+
+    results = pd.DataFrame(rows)
+    results.to_csv(os.path.join(out_dir, "results.csv"), index=False)
+    return results
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_prefix", help="trace store, e.g. Na_family")
+    parser.add_argument("--perplexities", type=float, nargs="+",
+                        default=[5, 10, 20, 30, 50])
+    parser.add_argument("--clusters", type=int, nargs="+",
+                        default=[4, 6, 8, 10])
+    parser.add_argument("--pca-dim", type=int, default=None)
+    parser.add_argument("--out-dir", default="sweep_results")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data_array = normalized_trace_matrix(TraceStore(args.store_prefix))
+    if (args.pca_dim is not None):
+        data_array, _ = pca_reduce(data_array, args.pca_dim)
+
+    results = parameter_sweep(data_array, args.perplexities, args.clusters,
+                                out_dir=args.out_dir,
+                                max_workers=args.workers, seed=args.seed)
+    print(results.sort_values("silhouette", ascending=False) \
+            .to_string(index=False))
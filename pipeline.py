@@ -0,0 +1,477 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_extraction_processing import ICG_API_URL, TRACE_NAMES, \
+    FAMILY_ID_TO_NAME, assemble_family_frame
+from trace_store import TraceStore
+from instrumentation import METRICS, stage
+
+# bump to invalidate all cached artifacts after a change of a stage
+PIPELINE_VERSION = 1
+
+# stages in execution order, with the stages whose artifacts they read
+STAGES = ["fetch", "assemble", "normalize", "reduce", "cluster", "render"]
+STAGE_INPUTS = {"fetch": [],
+                "assemble": ["fetch"],
+                "normalize": ["assemble"],
+                "reduce": ["normalize"],
+                "cluster": ["assemble", "normalize", "reduce"],
+                "render": ["assemble", "cluster"]}
+
+# parameters changing the output of a stage, hashed into its artifact key
+STAGE_PARAMS = {"fetch": ["family_id", "base_url", "protocols"],
+                "assemble": [],
+                "normalize": ["compress_method", "compress_length",
+                                "chunk_size"],
+                "reduce": ["pca_dim", "backend", "reduced_dim", "perplexity",
+                            "seed", "chunk_size"],
+                "cluster": ["n_kmeans_clusters", "minibatch", "seed"],
+                "render": ["attribute"]}
+
+DEFAULT_PARAMS = {"base_url": ICG_API_URL,
+                    "protocols": TRACE_NAMES,
+                    "compress_method": None,
+                    "compress_length": None,
+                    # rows per block of an out-of-core normalization and
+                    # incremental PCA (uncompressed traces only), None holds
+                    # the whole matrix in memory
+                    "chunk_size": None,
+                    # "auto" takes the dimensionality of the paper, ION_DIM
+                    "pca_dim": "auto",
+                    "backend": "bhsne",
+                    "reduced_dim": 2,
+                    "perplexity": 30,
+                    "seed": 0,
+                    "n_kmeans_clusters": 10,
+                    "minibatch": "auto",
+                    "attribute": "Animal_Model",
+                    # runtime options, not part of any artifact key
+                    "max_workers": 8,
+                    "requests_per_second": 10.,
+                    "http_cache_dir": None,
+                    "offline": False,
+                    "n_jobs": -1}
+
+
+
+def stage_key(stage, params, input_digests):
+    """
+    Returns the artifact key of a stage: a hash of the stage, its
+    parameters and the content digests of its input artifacts.
+    """
+    description = {"stage": stage, "version": PIPELINE_VERSION,
+                    "params": {name: params[name] for name in \
+                                STAGE_PARAMS[stage]},
+                    "inputs": input_digests}
+    return hashlib.sha1(json.dumps(description, sort_keys=True) \
+                        .encode("utf8")).hexdigest()
+
+
+
+def directory_digest(path, chunk_size=1 << 20):
+    """
+    Returns a hash over the names and contents of the files of an artifact
+    directory (without its manifest).
+    """
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        if (name == ArtifactCache.MANIFEST):
+            continue
+        sha.update(name.encode("utf8"))
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+
+class ArtifactCache():
+    """
+    Definition
+        Content addressed store of stage outputs: every artifact is a
+        directory "<root>/<stage>/<key>" holding the files of the stage and
+        a manifest with the parameters, input digests and the digest of its
+        own content. Downstream keys are built from that content digest, so
+        a stage re-executed with an identical result (e.g. a refetch of an
+        unchanged family) does not invalidate the stages after it.
+        Artifacts are built in a temporary directory and renamed into place,
+        so an interrupted stage never leaves a half written artifact.
+
+    Args:
+        root (str): directory of the cache
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root="pipeline_cache"):
+        self.root = root
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def manifest(self, stage, key):
+        """
+        Returns the manifest of an artifact, None if it does not exist.
+        """
+        try:
+            with open(os.path.join(self.path(stage, key), self.MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def build(self, stage, key, run, manifest):
+        """
+        Runs run(tmp_dir) to write an artifact, then moves it into place
+        (replacing an older artifact of the same key) and returns its
+        manifest.
+        """
+        path = self.path(stage, key)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        start = time.perf_counter()
+        try:
+            run(tmp_path)
+        except BaseException:
+            # no half written artifacts left behind by a failed stage
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        manifest = dict(manifest, digest=directory_digest(tmp_path),
+                        seconds=time.perf_counter() - start,
+                        created=time.time())
+        with open(os.path.join(tmp_path, self.MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+        if (os.path.exists(path)):
+            old_path = "{}.old-{}".format(path, os.getpid())
+            os.rename(path, old_path)
+            shutil.rmtree(old_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process built the same artifact in the meantime
+            shutil.rmtree(tmp_path)
+        return manifest
+
+
+
+def run_fetch(out_dir, inputs, params):
+    from icg_harvester import ICGHarvester, pooled_session
+    from icg_cache import ResponseCache
+    from channel_checkpoint import ChannelCheckpoint
+
+    if (params["offline"] and params["http_cache_dir"] is None):
+        raise ValueError("[!] Running offline needs the http_cache_dir of a \
+        response cache!")
+    session = None
+    if (params["http_cache_dir"] is not None):
+        session = ResponseCache(params["http_cache_dir"],
+                                session=pooled_session(params["max_workers"]),
+                                offline=params["offline"])
+
+    with ICGHarvester(base_url=params["base_url"],
+                        max_workers=params["max_workers"],
+                        requests_per_second=params["requests_per_second"],
+                        session=session,
+                        protocols=params["protocols"]) as harvester:
+        id_list = harvester.fetch_channel_ids(params["family_id"])
+        fetched = {_id: (meta, trace) for _id, meta, trace in \
+                    harvester.harvest(id_list)}
+
+    # channels sorted by id and no timestamp, so refetching an unchanged
+    # family writes an identical file (same digest, see ArtifactCache)
+    with ChannelCheckpoint(os.path.join(out_dir, "channels.jsonl"),
+                            sync_every=1000) as checkpoint:
+        checkpoint.record_listing(id_list, timestamp=False)
+        for _id in sorted(fetched):
+            checkpoint.append(_id, *fetched[_id])
+    return len(id_list)
+
+
+
+def run_assemble(out_dir, inputs, params):
+    from channel_checkpoint import ChannelCheckpoint
+    from trace_store import write_trace_store
+    from metadata_index import MetadataIndex
+
+    fetched, id_list = ChannelCheckpoint(os.path.join(inputs["fetch"],
+                                            "channels.jsonl")).load()
+    final_df, trace_block, protocols = assemble_family_frame(id_list,
+                                    FAMILY_ID_TO_NAME[params["family_id"]],
+                                    fetched)
+    store_prefix = os.path.join(out_dir, "family")
+    write_trace_store(store_prefix, final_df, trace_block, protocols=protocols)
+    MetadataIndex.build(final_df).save(store_prefix)
+    return len(final_df)
+
+
+
+def run_normalize(out_dir, inputs, params):
+    from preprocessing import normalized_trace_matrix, write_normalized_matrix
+
+    traces = TraceStore(os.path.join(inputs["assemble"], "family"))
+    out_file = os.path.join(out_dir, "normalized.npy")
+    if (params["compress_method"] is not None):
+        from trace_compression import compress_store
+        traces, _ = compress_store(traces, params["compress_length"],
+                                    method=params["compress_method"])
+    elif (params["chunk_size"] is not None):
+        # streamed from the memory mapped store straight into the artifact
+        data_array, stats = write_normalized_matrix(traces, out_file,
+                                                chunk_size=params["chunk_size"])
+        np.savez(os.path.join(out_dir, "stats.npz"), mean=stats.mean,
+                    std=stats.std)
+        return len(data_array)
+    data_array, mean, std = normalized_trace_matrix(traces, return_stats=True)
+    np.save(out_file, data_array)
+    np.savez(os.path.join(out_dir, "stats.npz"), mean=mean, std=std)
+    return len(data_array)
+
+
+
+def run_reduce(out_dir, inputs, params):
+    from preprocessing import pca_reduce
+    from embedding import embed
+
+    # with a chunk_size the normalized matrix stays on disk and the PCA is
+    # fitted incrementally, block by block
+    data_array = np.load(os.path.join(inputs["normalize"], "normalized.npy"),
+                            mmap_mode=None if params["chunk_size"] is None \
+                                        else "r")
+    pca = None
+    if (params["pca_dim"] is not None):
+        data_array, pca = pca_reduce(data_array, params["pca_dim"],
+                                        batch_size=params["chunk_size"],
+                                        random_state=params["seed"])
+    with open(os.path.join(out_dir, "pca.pickle"), "wb") as f:
+        pickle.dump(pca, f)
+    np.save(os.path.join(out_dir, "reduced.npy"), data_array)
+
+    data2d = embed(data_array, backend=params["backend"],
+                    reduced_dim=params["reduced_dim"],
+                    perplexity=params["perplexity"], n_jobs=params["n_jobs"],
+                    seed=params["seed"])
+    np.save(os.path.join(out_dir, "embedding.npy"), data2d)
+    return len(data2d)
+
+
+
+def run_cluster(out_dir, inputs, params):
+    from clustering import fit_clusters
+    from embedding_model import EmbeddingModel
+
+    data2d = np.load(os.path.join(inputs["reduce"], "embedding.npy"))
+    kmeans = fit_clusters(data2d, n_clusters=params["n_kmeans_clusters"],
+                            seed=params["seed"], minibatch=params["minibatch"],
+                            model_file=os.path.join(out_dir, "kmeans.pickle"))
+    pd.DataFrame({"Value1": data2d[:, 0], "Value2": data2d[:, 1],
+                    "Cluster": kmeans.labels_}) \
+        .to_pickle(os.path.join(out_dir, "plot_values.pickle"))
+
+    # the model places later channels into the map, which needs raw traces
+    # in the space the statistics were computed in, i.e. uncompressed ones
+    if (params["compress_method"] is None):
+        ids = TraceStore(os.path.join(inputs["assemble"], "family")) \
+                .meta['ID'].to_numpy()
+        stats = np.load(os.path.join(inputs["normalize"], "stats.npz"))
+        with open(os.path.join(inputs["reduce"], "pca.pickle"), "rb") as f:
+            pca = pickle.load(f)
+        reduced = np.load(os.path.join(inputs["reduce"], "reduced.npy"))
+        EmbeddingModel(ids, stats["mean"], stats["std"], pca, reduced, data2d,
+                        kmeans).save(os.path.join(out_dir, "model.pickle"))
+    return len(data2d)
+
+
+
+def run_render(out_dir, inputs, params):
+    from display_interactive_plot import interactive_plot_bokeh
+
+    interactive_plot_bokeh(os.path.join(inputs["cluster"],
+                                        "plot_values.pickle"),
+                            os.path.join(inputs["assemble"], "family"),
+                            attribute=params["attribute"],
+                            out_file=os.path.join(out_dir, "map.html"),
+                            open_browser=False)
+
+
+
+STAGE_FUNCTIONS = {"fetch": run_fetch,
+                    "assemble": run_assemble,
+                    "normalize": run_normalize,
+                    "reduce": run_reduce,
+                    "cluster": run_cluster,
+                    "render": run_render}
+
+
+
+def run_stage(name, out_dir, inputs, params):
+    """
+    Runs a stage function as an instrumented stage "pipeline_<name>", the
+    number of channels it returns gives the throughput.
+    """
+    with stage("pipeline_" + name,
+                family=FAMILY_ID_TO_NAME[params["family_id"]]) as record:
+        record["items"] = STAGE_FUNCTIONS[name](out_dir, inputs, params)
+
+
+
+def check_params(params):
+    """
+    Raises a ValueError for parameter combinations no stage can run with,
+    before any stage is executed.
+    """
+    if (params["compress_method"] is None):
+        return
+    from trace_compression import COMPRESSION_METHODS
+    if (params["compress_method"] not in COMPRESSION_METHODS):
+        raise ValueError("[!] Unknown compress_method {}, use one of {}!" \
+                            .format(params["compress_method"],
+                                    sorted(COMPRESSION_METHODS)))
+    if (params["compress_length"] is None):
+        raise ValueError("[!] compress_method {} needs a compress_length!" \
+                            .format(params["compress_method"]))
+    if (params["chunk_size"] is not None):
+        # the compressed traces are a matrix in memory, not a store which
+        # could be normalized out-of-core
+        raise ValueError("[!] chunk_size cannot be combined with \
+        compress_method, compressed traces are normalized in memory!")
+
+
+
+def run_family(family_id, params=None, cache_dir="pipeline_cache",
+                refetch=False, until="render"):
+    """
+    Definition
+        Runs the stages fetch -> assemble -> normalize -> reduce -> cluster
+        -> render for one family. A stage is only executed if there is no
+        artifact for its key yet (see ArtifactCache), i.e. if its parameters
+        or the content of its inputs changed. The fetch stage has no inputs
+        besides the api, so its artifact is reused until refetch is set.
+
+    Args:
+        family_id (int): family id, see FAMILY_ID_TO_NAME
+        params (dict): overrides of DEFAULT_PARAMS
+        cache_dir (str): root of the artifact cache
+        refetch (bool): fetch the family from the api again
+        until (str): last stage to run
+
+    Outputs:
+        artifacts (dict): stage -> artifact directory
+    """
+    params = dict(DEFAULT_PARAMS, **(params or {}), family_id=family_id)
+    family_name = FAMILY_ID_TO_NAME[family_id]
+    if (params["pca_dim"] == "auto"):
+        from preprocessing import ION_DIM
+        params["pca_dim"] = ION_DIM[family_name]
+    check_params(params)
+
+    # worker processes can run several families, count each one on its own
+    METRICS.reset()
+    cache = ArtifactCache(cache_dir)
+    artifacts = {}
+    digests = {}
+    for stage_name in STAGES[:STAGES.index(until) + 1]:
+        input_digests = {name: digests[name] for name in \
+                            STAGE_INPUTS[stage_name]}
+        key = stage_key(stage_name, params, input_digests)
+        manifest = cache.manifest(stage_name, key)
+
+        if (manifest is None or (stage_name == "fetch" and refetch)):
+            print("[+] {}: running {}".format(family_name, stage_name))
+            inputs = {name: artifacts[name] for name in \
+                        STAGE_INPUTS[stage_name]}
+            manifest = cache.build(stage_name, key,
+                        lambda out_dir: run_stage(stage_name, out_dir, inputs,
+                                                    params),
+                        {"stage": stage_name, "family": family_name,
+                            "params": {name: params[name] for name in \
+                                        STAGE_PARAMS[stage_name]},
+                            "inputs": input_digests})
+        else:
+            print("[+] {}: reusing {} artifact {}".format(family_name,
+                                                    stage_name, key[:12]))
+        artifacts[stage_name] = cache.path(stage_name, key)
+        digests[stage_name] = manifest["digest"]
+
+    # request counters and latency histograms of this (worker) process
+    METRICS.emit_totals(family=family_name)
+
+    return artifacts
+
+
+
+def run_pipeline(family_ids, params=None, cache_dir="pipeline_cache",
+                    refetch=False, until="render", max_processes=None):
+    """
+    Runs run_family for every family, independent families in parallel
+    worker processes. Returns a dictionary family name -> artifacts.
+    """
+    if (len(family_ids) == 1):
+        return {FAMILY_ID_TO_NAME[family_ids[0]]: run_family(family_ids[0],
+                    params, cache_dir, refetch, until)}
+
+    with ProcessPoolExecutor(max_workers=max_processes) as executor:
+        futures = {FAMILY_ID_TO_NAME[family_id]: executor.submit(run_family,
+                    family_id, params, cache_dir, refetch, until) \
+                    for family_id in family_ids}
+        return {name: future.result() for name, future in futures.items()}
+
+
+
+if (__name__=="__main__"):
+    name_to_family_id = {name: _id for _id, name in FAMILY_ID_TO_NAME.items()}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("families", nargs="*", default=["Na"],
+                        help="family names ({}) or 'all'".format(
+                                ", ".join(name_to_family_id)))
+    parser.add_argument("--until", choices=STAGES, default="render")
+    parser.add_argument("--refetch", action="store_true")
+    parser.add_argument("--cache-dir", default="pipeline_cache")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--metrics-file", default=None,
+                        help="append stage timings and request metrics of \
+                                all processes to this json lines file")
+    parser.add_argument("--prometheus-file", default=None,
+                        help="dump the metrics of this process in \
+                                prometheus text format")
+    parser.add_argument("--profile-dir", default=None,
+                        help="cProfile every stage into this directory")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="report the python heap peak of every stage")
+    parser.add_argument("--params", default="{}",
+                        help="json object overriding DEFAULT_PARAMS, e.g. \
+                                '{\"backend\": \"sklearn\", \"seed\": 1}'")
+    args = parser.parse_args()
+
+    # through the environment, so spawned worker processes pick it up too
+    for variable, value in (("ICG_METRICS_FILE", args.metrics_file),
+                            ("ICG_PROFILE_DIR", args.profile_dir),
+                            ("ICG_TRACEMALLOC",
+                                "1" if args.tracemalloc else None)):
+        if (value is not None):
+            os.environ[variable] = value
+    METRICS.configure(args.metrics_file, args.profile_dir, args.tracemalloc)
+
+    if (args.families == ["all"]):
+        family_ids = sorted(FAMILY_ID_TO_NAME)
+    else:
+        family_ids = [name_to_family_id[name] for name in args.families]
+
+    results = run_pipeline(family_ids, json.loads(args.params),
+                            cache_dir=args.cache_dir, refetch=args.refetch,
+                            until=args.until, max_processes=args.processes)
+    for family_name, artifacts in results.items():
+        print("[+] {}: {}".format(family_name,
+                                    artifacts[args.until]))
+    if (args.prometheus_file is not None):
+        METRICS.dump(args.prometheus_file, format="prometheus")
@@ -0,0 +1,44 @@
+from functools import lru_cache
+
+from prettytable import PrettyTable
+
+
+
+def create_label_for_matplotlib(series_of_dp):
+    """
+    Definition
+        Creates a nice formatted string of all the value and they keys of a
+        panda series.
+    """
+    label = PrettyTable(["Attribute", "Value"])
+    exclude = ["Conc_Trace", "Temperature"]
+    for attribute in series_of_dp.keys():
+        if (attribute not in exclude):
+            label.add_row([attribute, series_of_dp[attribute]])
+
+    return str(label)
+
+
+
+class LabelRenderer():
+    """
+    Definition
+        Creates the label of a datapoint only when it is needed (clicked or
+        hovered), from the metadata row of the datapoint. The last
+        cache_size labels are kept in an LRU cache, so going back and forth
+        between points does not format the tables again.
+
+    Args:
+        meta_df (pd.DataFrame): metadata, row i belonging to datapoint i
+        cache_size (int): number of cached labels
+    """
+
+    def __init__(self, meta_df, cache_size=256):
+        self.meta_df = meta_df
+        self.label = lru_cache(maxsize=cache_size)(self._render)
+
+    def _render(self, row):
+        return create_label_for_matplotlib(self.meta_df.iloc[row])
+
+    def __call__(self, row):
+        return self.label(int(row))
@@ -0,0 +1,355 @@
+import argparse
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA, IncrementalPCA
+
+from instrumentation import stage
+from trace_store import TraceStore
+
+# number of dimensions the data was reduced too in the paper
+# corresponding to the ion
+ION_DIM = {"K":16, "Na":21, "Ca":29, "IH":16, "KCa":16}
+
+
+
+def build_trace_matrix(traces, dtype=np.float64):
+    """
+    Definition
+        Builds the (n_channels x n_trace_values) matrix of voltage traces in
+        one vectorized step.
+
+    Args:
+        traces: family dataframe with a 'Conc_Trace' column, a TraceStore or
+                anything numpy can turn into a 2-D array
+        dtype (np.dtype): dtype of the matrix, float32 halves the memory
+
+    Outputs:
+        data_array (np.ndarray): new, writable trace matrix
+    """
+    if (isinstance(traces, pd.DataFrame)):
+        traces = traces['Conc_Trace']
+    if (isinstance(traces, pd.Series)):
+        # rows are equally long lists or arrays, stack them at once
+        return np.stack(traces.to_numpy()).astype(dtype, copy=False)
+    if (hasattr(traces, "traces")):
+        # TraceStore, copy out of the read only memory map
+        traces = traces.traces
+
+    return np.array(traces, dtype=dtype)
+
+
+
+def column_mean_std(data_array):
+    """
+    Returns column mean and standard deviation of a matrix, with zero
+    standard deviations replaced by 1.
+    """
+    mean = data_array.mean(axis=0)
+    std = data_array.std(axis=0)
+    std[std == 0] = 1.
+    return mean, std
+
+
+
+def zscore_columns(data_array, copy=False, mean=None, std=None):
+    """
+    Definition
+        "we normalized each column by Z-scoring: we substracted its mean and
+        then divided by its standard deviation"
+        Done in place with broadcast column statistics. Columns with zero
+        variance (e.g. a constant holding potential) would divide by zero, so
+        they are only centered, which makes them all zeros.
+
+    Args:
+        data_array (np.ndarray): float matrix, normalized in place
+        copy (bool): normalize a copy instead
+        mean, std (np.ndarray): previously computed column statistics (e.g.
+                                of the data an embedding was fitted on),
+                                computed from data_array if not given
+
+    Outputs:
+        data_array (np.ndarray): the normalized matrix
+    """
+    if (copy):
+        data_array = data_array.copy()
+
+    if (mean is None or std is None):
+        mean, std = column_mean_std(data_array)
+
+    data_array -= mean
+    data_array /= std
+
+    return data_array
+
+
+
+def normalized_trace_matrix(traces, dtype=np.float64, return_stats=False):
+    """
+    Builds the trace matrix and Z-scores its columns. With return_stats,
+    the column mean and standard deviation are returned as well.
+    """
+    with stage("build_matrix") as record:
+        data_array = build_trace_matrix(traces, dtype=dtype)
+        record["items"] = data_array.shape[0]
+    with stage("zscore", items=data_array.shape[0]):
+        mean, std = column_mean_std(data_array)
+        data_array = zscore_columns(data_array, mean=mean, std=std)
+
+    if (return_stats):
+        return data_array, mean, std
+    return data_array
+
+
+
+class RunningColumnStats():
+    """
+    Definition
+        Streaming column mean and variance over blocks of rows. Each block is
+        reduced vectorized and merged into the running statistics with the
+        parallel formula of Chan et al. (the block-wise form of Welford's
+        algorithm), which stays numerically stable for long streams.
+        Accumulation is always done in float64.
+    """
+
+    def __init__(self, n_columns):
+        self.count = 0
+        self.mean = np.zeros(n_columns, dtype=np.float64)
+        # sum of squared deviations from the mean
+        self.m2 = np.zeros(n_columns, dtype=np.float64)
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        n_block = block.shape[0]
+        if (n_block == 0):
+            return self
+
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean)**2).sum(axis=0)
+
+        n_total = self.count + n_block
+        delta = block_mean - self.mean
+        self.mean += delta * (n_block / n_total)
+        self.m2 += block_m2 + delta**2 * (self.count * n_block / n_total)
+        self.count = n_total
+        return self
+
+    def merge(self, other):
+        """
+        Merges the statistics of another (e.g. parallel computed) stream.
+        """
+        if (other.count == 0):
+            return self
+        n_total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / n_total)
+        self.m2 += other.m2 + delta**2 * (self.count * other.count / n_total)
+        self.count = n_total
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        """
+        Population standard deviation (as np.std), zeros replaced by 1.
+        """
+        std = np.sqrt(self.variance)
+        std[std == 0] = 1.
+        return std
+
+
+
+def iter_trace_blocks(stores, chunk_size=1024):
+    """
+    Yields blocks of at most chunk_size trace rows from one or several
+    TraceStores (e.g. all five families), one after another.
+    """
+    if (hasattr(stores, "traces")):
+        stores = [stores]
+    for store in stores:
+        for _, block in store.iter_blocks(chunk_size):
+            yield block
+
+
+
+def streaming_column_stats(stores, chunk_size=1024):
+    """
+    Computes the column statistics of one or several TraceStores, holding
+    only chunk_size rows in memory at a time.
+    """
+    if (hasattr(stores, "traces")):
+        stores = [stores]
+    n_columns = {store.n_trace_values for store in stores}
+    if (len(n_columns) != 1):
+        raise ValueError("[!] Stores have different trace lengths: {}!" \
+                            .format(sorted(n_columns)))
+
+    stats = RunningColumnStats(n_columns.pop())
+    for block in iter_trace_blocks(stores, chunk_size):
+        stats.update(block)
+    return stats
+
+
+
+def iter_normalized_blocks(stores, stats, chunk_size=1024, dtype=np.float32):
+    """
+    Yields Z-scored blocks of at most chunk_size rows, normalized with
+    already computed column statistics.
+    """
+    mean = stats.mean.astype(dtype)
+    std = stats.std.astype(dtype)
+    for block in iter_trace_blocks(stores, chunk_size):
+        block = block.astype(dtype)
+        block -= mean
+        block /= std
+        yield block
+
+
+
+def write_normalized_matrix(stores, out_file, chunk_size=1024,
+                            dtype=np.float32):
+    """
+    Definition
+        Out-of-core Z-scoring: a first pass over the stores computes the
+        column statistics, a second pass writes the normalized rows into an
+        .npy file. Peak memory is bounded by chunk_size rows, not by the
+        size of the (merged) dataset.
+
+    Args:
+        stores: a TraceStore or a list of them
+        out_file (str): .npy file the normalized matrix is written to
+        chunk_size (int): number of rows processed at once
+        dtype (np.dtype): dtype of the normalized matrix
+
+    Outputs:
+        normalized (np.memmap): read only memory map of the written matrix
+        stats (RunningColumnStats): the column statistics used
+    """
+    if (hasattr(stores, "traces")):
+        stores = [stores]
+    stats = streaming_column_stats(stores, chunk_size)
+
+    out = np.lib.format.open_memmap(out_file, mode="w+", dtype=dtype,
+                                    shape=(stats.count, len(stats.mean)))
+    row = 0
+    for block in iter_normalized_blocks(stores, stats, chunk_size, dtype):
+        out[row:row + block.shape[0]] = block
+        row += block.shape[0]
+    out.flush()
+    del out
+
+    return np.load(out_file, mmap_mode="r"), stats
+
+
+
+def matrix_fingerprint(data_array):
+    """
+    Returns a sha1 hex digest of the shape, dtype and content of a matrix.
+    """
+    digest = hashlib.sha1()
+    digest.update(str((data_array.shape, data_array.dtype.str)).encode())
+    for block in np.array_split(data_array, max(1, data_array.shape[0]//4096)):
+        digest.update(np.ascontiguousarray(block).tobytes())
+    return digest.hexdigest()
+
+
+
+def pca_reduce(data_array, n_components, cache_file=None, batch_size=None,
+                random_state=0):
+    """
+    Definition
+        Projects the (normalized) trace matrix onto its first n_components
+        principal components, in front of t-SNE. Randomized PCA is used,
+        which only computes the leading components; with a batch_size an
+        IncrementalPCA is fitted block by block instead (e.g. on a memmap).
+        The fitted projection is pickled into cache_file together with a
+        fingerprint of its input, so a re-run on the same data skips the
+        fit.
+
+    Args:
+        data_array (np.ndarray): (n_channels x n_trace_values) matrix
+        n_components (int): target dimensionality, see ION_DIM
+        cache_file (str): pickle of the fitted projection, None disables it
+        batch_size (int): rows per partial fit of an IncrementalPCA, at
+                            least n_components
+        random_state (int): seed of the randomized solver
+
+    Outputs:
+        reduced (np.ndarray): (n_channels x n_components) matrix
+        pca (PCA): the fitted projection
+    """
+    fingerprint = matrix_fingerprint(data_array)
+    key = (fingerprint, n_components, batch_size, random_state)
+
+    pca = None
+    if (cache_file is not None and os.path.exists(cache_file)):
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        if (cached["key"] == key):
+            pca = cached["pca"]
+            print("[+] Reusing PCA projection from", cache_file)
+
+    if (pca is None):
+        with stage("pca_fit", items=data_array.shape[0]):
+            if (batch_size is None):
+                pca = PCA(n_components=n_components, svd_solver="randomized",
+                            random_state=random_state)
+                pca.fit(data_array)
+            else:
+                pca = IncrementalPCA(n_components=n_components,
+                                        batch_size=batch_size)
+                # equally sized batches, so the last one is not smaller than
+                # n_components
+                n_batches = max(1, data_array.shape[0] // batch_size)
+                for block in np.array_split(data_array, n_batches):
+                    pca.partial_fit(block)
+
+        if (cache_file is not None):
+            with open(cache_file, "wb") as f:
+                pickle.dump({"key": key, "pca": pca}, f)
+
+    print("[+] PCA to {} dims explains {:.1%} of the variance".format( \
+            n_components, pca.explained_variance_ratio_.sum()))
+
+    if (batch_size is None):
+        return pca.transform(data_array), pca
+    # block by block as well, so a memory mapped matrix is never loaded whole
+    return np.vstack([pca.transform(data_array[start:start + batch_size]) \
+                        for start in range(0, data_array.shape[0],
+                                            batch_size)]), pca
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser(description="Z-scores one or several \
+                                    trace stores (e.g. all families) into \
+                                    one .npy matrix, out-of-core")
+    parser.add_argument("out_file", help="normalized matrix, e.g. all.npy")
+    parser.add_argument("store_prefixes", nargs="+",
+                        help="trace stores, e.g. Na_family K_family")
+    parser.add_argument("--chunk-size", type=int, default=4096,
+                        help="rows held in memory at a time")
+    parser.add_argument("--stats-file", default=None,
+                        help="save column mean and std to this .npz file")
+    parser.add_argument("--pca-dim", type=int, default=None,
+                        help="also reduce with an incremental PCA into \
+                                <out_file>_pca.npy")
+    args = parser.parse_args()
+
+    stores = [TraceStore(prefix) for prefix in args.store_prefixes]
+    normalized, stats = write_normalized_matrix(stores, args.out_file,
+                                                chunk_size=args.chunk_size)
+    print("[+] Normalized {} channels into {}".format(len(normalized),
+                                                        args.out_file))
+    if (args.stats_file is not None):
+        np.savez(args.stats_file, mean=stats.mean, std=stats.std)
+    if (args.pca_dim is not None):
+        reduced, _ = pca_reduce(normalized, args.pca_dim,
+                                batch_size=max(args.chunk_size, args.pca_dim))
+        np.save(os.path.splitext(args.out_file)[0] + "_pca.npy", reduced)
@@ -0,0 +1,225 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from trace_store import TraceStore
+from preprocessing import normalized_trace_matrix, build_trace_matrix, \
+    zscore_columns, pca_reduce, matrix_fingerprint, ION_DIM
+
+
+
+class ChannelSimilarityIndex():
+    """
+    Definition
+        Nearest neighbour search over the normalized (and optionally PCA
+        reduced) trace vectors of a family, answering e.g. "which channels
+        behave most like channel 2706". The vectors are kept in a ball tree,
+        so a query costs O(log N) instead of a brute force pass, and the
+        whole index is persisted with pickle, together with the source it
+        was built from (fingerprint of the store, PCA dimensionality), so a
+        stale index can be detected (see is_built_from).
+
+    Args:
+        ids (np.ndarray): channel id of every vector
+        mean, std (np.ndarray): column statistics of the Z-scoring
+        pca (PCA): fitted projection, None if no PCA was applied
+        vectors (np.ndarray): normalized (reduced) traces, row i of ids[i]
+        leaf_size (int): leaf size of the ball tree
+        source (dict): what the index was built from, see source_of
+    """
+
+    def __init__(self, ids, mean, std, pca, vectors, leaf_size=40,
+                    source=None):
+        self.ids = np.asarray(ids)
+        self.source = source
+        self.mean = mean
+        self.std = std
+        self.pca = pca
+        self.tree = BallTree(vectors, leaf_size=leaf_size)
+        self.row_of_id = {_id: row for row, _id in \
+                            enumerate(self.ids.tolist())}
+
+    @staticmethod
+    def source_of(store, pca_dim="auto"):
+        """
+        Definition
+            Describes the index a store and pca_dim give: fingerprints of
+            its traces and ids and the PCA dimensionality, "auto" resolved
+            to ION_DIM of the family (a ball tree over thousands of raw
+            columns is hardly faster than brute force) and capped by the
+            size of the store.
+        """
+        if (pca_dim == "auto"):
+            families = store.meta['Family'].unique() if len(store) else []
+            pca_dim = ION_DIM.get(families[0]) if len(families) == 1 \
+                        else None
+        if (pca_dim is not None):
+            pca_dim = min(pca_dim, len(store), store.n_trace_values)
+        return {"traces": matrix_fingerprint(store.traces),
+                "ids": matrix_fingerprint(store.meta['ID'].to_numpy()),
+                "pca_dim": pca_dim}
+
+    @classmethod
+    def build(cls, store_prefix, pca_dim="auto", leaf_size=40):
+        """
+        Builds the index over the trace store with the given prefix,
+        pca_dim "auto" reduces to ION_DIM of the family, None disables the
+        PCA.
+        """
+        store = TraceStore(store_prefix)
+        source = cls.source_of(store, pca_dim)
+        vectors, mean, std = normalized_trace_matrix(store, return_stats=True)
+        pca = None
+        if (source["pca_dim"] is not None):
+            vectors, pca = pca_reduce(vectors, source["pca_dim"])
+        return cls(store.meta['ID'].to_numpy(), mean, std, pca, vectors,
+                    leaf_size=leaf_size, source=source)
+
+    def is_built_from(self, store_prefix, pca_dim="auto"):
+        """
+        Returns whether the index is up to date with the store and pca_dim,
+        i.e. neither the store was dumped again nor another PCA requested.
+        """
+        return self.source is not None and \
+                self.source == self.source_of(TraceStore(store_prefix),
+                                                pca_dim)
+
+    def save(self, file_name):
+        # only plain state is pickled (not the class), so an index saved by
+        # running this file as a script can be loaded from anywhere
+        state = {"ids": self.ids, "mean": self.mean, "std": self.std,
+                    "pca": self.pca, "tree": self.tree, "source": self.source}
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, "rb") as f:
+            state = pickle.load(f)
+        index = cls.__new__(cls)
+        # indexes saved before the source was recorded count as stale
+        index.source = None
+        index.__dict__.update(state)
+        index.row_of_id = {_id: row for row, _id in \
+                            enumerate(index.ids.tolist())}
+        return index
+
+    def vectors_of_traces(self, traces):
+        """
+        Normalizes and projects raw traces like the indexed ones.
+        """
+        data_array = build_trace_matrix(traces, dtype=np.float64)
+        if (data_array.ndim == 1):
+            data_array = data_array[np.newaxis]
+        data_array = zscore_columns(data_array, mean=self.mean, std=self.std)
+        if (self.pca is not None):
+            data_array = self.pca.transform(data_array)
+        return data_array
+
+    def vectors_of_ids(self, ids):
+        """
+        Returns the indexed vectors of the given channel ids.
+        """
+        missing = [_id for _id in ids if _id not in self.row_of_id]
+        if (missing):
+            raise KeyError("[!] Channels {} are not indexed!".format(missing))
+        rows = [self.row_of_id[_id] for _id in ids]
+        return np.asarray(self.tree.data)[rows]
+
+    def query_batch(self, vectors, k=10):
+        """
+        Definition
+            k nearest indexed channels of every given vector.
+
+        Outputs:
+            ids (np.ndarray): (n_queries x k) channel ids, nearest first
+            distances (np.ndarray): (n_queries x k) euclidean distances
+        """
+        k = min(k, len(self.ids))
+        distances, rows = self.tree.query(vectors, k=k)
+        return self.ids[rows], distances
+
+    def query_by_trace(self, trace, k=10):
+        """
+        Returns a list of (channel id, distance) of the k channels closest
+        to a raw concatenated trace.
+        """
+        ids, distances = self.query_batch(self.vectors_of_traces(trace), k)
+        return list(zip(ids[0].tolist(), distances[0].tolist()))
+
+    def query_by_id(self, channel_id, k=10):
+        """
+        Returns a list of (channel id, distance) of the k channels closest
+        to an indexed channel, without the channel itself.
+        """
+        ids, distances = self.query_batch(self.vectors_of_ids([channel_id]),
+                                            k + 1)
+        return [(_id, distance) for _id, distance in \
+                zip(ids[0].tolist(), distances[0].tolist()) \
+                if _id != channel_id][:k]
+
+    def near_duplicates(self, radius):
+        """
+        Definition
+            Finds all pairs of indexed channels closer than radius, e.g. the
+            same model uploaded twice.
+
+        Outputs:
+            pairs (list): (id a, id b, distance) tuples, closest first
+        """
+        vectors = np.asarray(self.tree.data)
+        rows, distances = self.tree.query_radius(vectors, r=radius,
+                                                    return_distance=True)
+        pairs = []
+        for row, (neighbors, neighbor_distances) in \
+                enumerate(zip(rows, distances)):
+            for neighbor, distance in zip(neighbors, neighbor_distances):
+                if (neighbor > row):
+                    pairs.append((self.ids[row].item(),
+                                    self.ids[neighbor].item(), float(distance)))
+        pairs.sort(key=lambda pair: pair[2])
+        return pairs
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_prefix", help="trace store, e.g. Na_family")
+    parser.add_argument("--ids", type=int, nargs="+", default=[],
+                        help="channel ids to find similar channels for")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--duplicates", type=float, default=None,
+                        help="list all pairs closer than this distance")
+    parser.add_argument("--pca-dim", type=int, default=None,
+                        help="PCA dimensionality, by default ION_DIM of the \
+                                family, 0 disables the PCA")
+    parser.add_argument("--index-file", default=None,
+                        help="persisted index, built and saved if missing")
+    args = parser.parse_args()
+
+    pca_dim = {None: "auto", 0: None}.get(args.pca_dim, args.pca_dim)
+    index_file = args.index_file or args.store_prefix + "_similarity.pickle"
+    index = None
+    if (os.path.exists(index_file)):
+        index = ChannelSimilarityIndex.load(index_file)
+        if (not index.is_built_from(args.store_prefix, pca_dim)):
+            print("[+] Rebuilding", index_file, "(store or PCA changed)")
+            index = None
+    if (index is None):
+        index = ChannelSimilarityIndex.build(args.store_prefix,
+                                                pca_dim=pca_dim)
+        index.save(index_file)
+
+    for channel_id in args.ids:
+        print("[+] Channels most similar to", channel_id)
+        for _id, distance in index.query_by_id(channel_id, k=args.k):
+            print("    {:>8} {:10.4f}".format(_id, distance))
+
+    if (args.duplicates is not None):
+        for id_a, id_b, distance in index.near_duplicates(args.duplicates):
+            print("    {:>8} {:>8} {:10.4f}".format(id_a, id_b, distance))
@@ -0,0 +1,219 @@
+import argparse
+import time
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import resample_poly
+from sklearn.metrics import adjusted_rand_score, adjusted_mutual_info_score
+
+from trace_store import TraceStore, write_trace_store
+from preprocessing import normalized_trace_matrix
+from embedding import embed
+from clustering import fit_clusters
+
+
+
+def decimate_block(block, target_length):
+    """
+    Resamples every row of a block to target_length values with a polyphase
+    filter, which low-pass filters (anti-aliasing) before downsampling.
+    """
+    n_values = block.shape[1]
+    if (target_length >= n_values):
+        return np.array(block, dtype=np.float64)
+    ratio = Fraction(target_length, n_values).limit_denominator(1000)
+    resampled = resample_poly(np.asarray(block, dtype=np.float64),
+                                ratio.numerator, ratio.denominator, axis=1)
+    # the rational approximation can be off by a few values
+    if (resampled.shape[1] < target_length):
+        resampled = np.pad(resampled,
+                            ((0, 0), (0, target_length - resampled.shape[1])),
+                            mode="edge")
+    return resampled[:, :target_length]
+
+
+
+def paa_block(block, target_length):
+    """
+    Piecewise aggregate approximation: every row is cut into target_length
+    (nearly) equally long segments, which are replaced by their mean.
+    """
+    n_values = block.shape[1]
+    if (target_length >= n_values):
+        return np.array(block, dtype=np.float64)
+    bounds = np.linspace(0, n_values, target_length + 1).astype(np.int64)
+    sums = np.add.reduceat(np.asarray(block, dtype=np.float64), bounds[:-1],
+                            axis=1)
+    return sums / np.diff(bounds)
+
+
+
+def wavelet_block(block, target_length, wavelet="haar"):
+    """
+    Keeps the approximation coefficients of a multilevel discrete wavelet
+    transform, at the coarsest level still having at least target_length
+    coefficients (cut to target_length). Uses PyWavelets if installed,
+    otherwise an own Haar transform.
+    """
+    block = np.asarray(block, dtype=np.float64)
+    n_values = block.shape[1]
+    if (target_length >= n_values):
+        return block.copy()
+    level = max(0, int(np.floor(np.log2(n_values / target_length))))
+
+    try:
+        import pywt
+        approximation = pywt.wavedec(block, wavelet, level=level, axis=1)[0]
+    except ImportError:
+        approximation = block
+        for _ in range(level):
+            if (approximation.shape[1] % 2):
+                approximation = np.pad(approximation, ((0, 0), (0, 1)),
+                                        mode="edge")
+            approximation = (approximation[:, ::2] + approximation[:, 1::2]) \
+                            / np.sqrt(2)
+
+    return paa_block(approximation, target_length)
+
+
+
+# name -> function(block, target_length)
+COMPRESSION_METHODS = {"decimate": decimate_block,
+                        "paa": paa_block,
+                        "wavelet": wavelet_block}
+
+
+
+def compress_store(store, target_lengths, method="paa", protocols=None,
+                    chunk_size=4096):
+    """
+    Definition
+        Compresses every protocol of a trace store to its target length, one
+        block of rows at a time.
+
+    Args:
+        store (TraceStore): store to compress
+        target_lengths (int or dict): target length of every protocol, or a
+                                        dictionary protocol:target length
+        method (str): one of COMPRESSION_METHODS
+        protocols (list): protocols to keep, None for all of the store
+        chunk_size (int): rows compressed at once
+
+    Outputs:
+        compressed (np.ndarray): (n_channels x sum of target lengths) matrix
+        new_protocols (list): (protocol, start, stop) column ranges
+    """
+    compress = COMPRESSION_METHODS[method]
+    if (protocols is None):
+        protocols = store.protocols or [None]
+
+    blocks = []
+    new_protocols = []
+    start = 0
+    for name in protocols:
+        # a store without protocol ranges is compressed as a whole
+        view = store.traces if name is None else store.protocol(name)
+        if (isinstance(target_lengths, dict)):
+            target_length = target_lengths.get(name, view.shape[1])
+        else:
+            target_length = target_lengths
+        target_length = min(target_length, view.shape[1])
+
+        compressed = np.empty((view.shape[0], target_length), dtype=np.float32)
+        for row in range(0, view.shape[0], chunk_size):
+            compressed[row:row + chunk_size] = compress(
+                                        view[row:row + chunk_size], target_length)
+        blocks.append(compressed)
+        if (name is not None):
+            new_protocols.append((name, start, start + target_length))
+        start += target_length
+
+    return np.hstack(blocks), new_protocols
+
+
+
+def compress_trace_store(prefix, out_prefix, target_lengths, method="paa",
+                            protocols=None):
+    """
+    Writes a compressed copy of a trace store, which can then be used by
+    every later stage in place of the original one.
+    """
+    store = TraceStore(prefix)
+    compressed, new_protocols = compress_store(store, target_lengths, method,
+                                                protocols)
+    final_df = store.meta.copy()
+    final_df['Conc_Trace'] = list(compressed)
+    write_trace_store(out_prefix, final_df, compressed,
+                        protocols=new_protocols or None)
+    print("[+] Compressed {} values per channel to {} in {}".format(
+            store.n_trace_values, compressed.shape[1], out_prefix))
+    return compressed
+
+
+
+def fidelity_report(full_matrix, compressed_matrix, n_kmeans_clusters=10,
+                    backend="sklearn", perplexity=30, seed=0):
+    """
+    Definition
+        Embeds and clusters the uncompressed and the compressed traces the
+        same way (same backend, seed and cluster count) and compares the
+        cluster assignments with the adjusted Rand index and the adjusted
+        mutual information (1 = identical clusterings, ~0 = unrelated).
+
+    Outputs:
+        report (dict): sizes, timings and agreement scores
+    """
+    report = {"n_values_full": full_matrix.shape[1],
+                "n_values_compressed": compressed_matrix.shape[1]}
+    labels = {}
+    for name, matrix in (("full", full_matrix),
+                            ("compressed", compressed_matrix)):
+        start = time.perf_counter()
+        data2d = embed(normalized_trace_matrix(matrix), backend=backend,
+                        perplexity=perplexity, seed=seed)
+        report["embed_time_" + name] = time.perf_counter() - start
+        labels[name] = fit_clusters(data2d, n_clusters=n_kmeans_clusters,
+                                    seed=seed).labels_
+
+    report["adjusted_rand"] = adjusted_rand_score(labels["full"],
+                                                    labels["compressed"])
+    report["adjusted_mutual_info"] = adjusted_mutual_info_score(
+                                        labels["full"], labels["compressed"])
+    return report
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_prefix", help="trace store, e.g. Na_family")
+    parser.add_argument("out_prefix", help="compressed store, e.g. Na_paa")
+    parser.add_argument("--method", choices=sorted(COMPRESSION_METHODS),
+                        default="paa")
+    parser.add_argument("--length", type=int, default=100,
+                        help="target length of every protocol")
+    parser.add_argument("--protocol-length", nargs=2, action="append",
+                        default=[], metavar=("PROTOCOL", "LENGTH"),
+                        help="target length of one protocol")
+    parser.add_argument("--report", action="store_true",
+                        help="compare cluster assignments before and after")
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--backend", default="sklearn")
+    args = parser.parse_args()
+
+    store = TraceStore(args.store_prefix)
+    if (args.protocol_length and not store.protocols):
+        parser.error("--protocol-length needs a store with protocol ranges, "
+                        "{} has none".format(args.store_prefix))
+    target_lengths = {name: args.length for name in store.protocols} \
+                        if store.protocols else args.length
+    for name, length in args.protocol_length:
+        target_lengths[name] = int(length)
+
+    compressed = compress_trace_store(args.store_prefix, args.out_prefix,
+                                        target_lengths, method=args.method)
+    if (args.report):
+        report = fidelity_report(np.asarray(store.traces), compressed,
+                                    n_kmeans_clusters=args.clusters,
+                                    backend=args.backend)
+        for key, value in report.items():
+            print("    {:>22}: {}".format(key, value))
@@ -0,0 +1,207 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# version of the on-disk layout, stored in the sidecar
+# (2: protocol column ranges in the sidecar)
+STORE_VERSION = 2
+
+
+
+def store_file_names(prefix):
+    """
+    Returns the names of the trace matrix and the metadata sidecar of the
+    trace store with the given prefix (e.g. "Na_family").
+    """
+    return prefix + "_traces.npy", prefix + "_metadata.json"
+
+
+
+def write_trace_store(prefix, final_df, trace_block=None, dtype=np.float32,
+                        protocols=None):
+    """
+    Definition
+        Writes a family into a trace store: all traces as one fixed width
+        (n_channels x n_trace_values) matrix in an .npy file, which can be
+        memory mapped, and every other column of the dataframe into a json
+        sidecar.
+
+    Args:
+        prefix (str): prefix of the store files, e.g. "Na_family"
+        final_df (pd.DataFrame): family dataframe as built by
+                                    assemble_family_frame
+        trace_block (np.ndarray): contiguous trace matrix, built from the
+                                    Conc_Trace column if not given
+        dtype (np.dtype): dtype the traces are stored with
+        protocols (list): (protocol, start, stop) column ranges of the
+                            protocols in the trace matrix, as returned by
+                            assemble_family_frame
+    """
+    trace_name, meta_name = store_file_names(prefix)
+
+    if (trace_block is None):
+        trace_block = np.array(list(final_df['Conc_Trace']), dtype=dtype)
+
+    # the matrix is written first, the sidecar last, so a readable sidecar
+    # always refers to a complete matrix
+    tmp_name = trace_name + ".tmp"
+    with open(tmp_name, "wb") as f:
+        np.save(f, np.ascontiguousarray(trace_block, dtype=dtype))
+    os.replace(tmp_name, trace_name)
+
+    meta_df = final_df.drop(columns=['Conc_Trace'])
+    sidecar = {"version": STORE_VERSION,
+                "n_channels": int(trace_block.shape[0]),
+                "n_trace_values": int(trace_block.shape[1]),
+                "dtype": np.dtype(dtype).name,
+                "protocols": [[name, int(start), int(stop)] for \
+                                name, start, stop in (protocols or [])],
+                "columns": {column: meta_df[column].tolist() for column in \
+                            meta_df.columns}}
+    tmp_name = meta_name + ".tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(sidecar, f)
+    os.replace(tmp_name, meta_name)
+
+    return trace_name, meta_name
+
+
+
+def load_metadata(prefix):
+    """
+    Reads only the metadata sidecar of a trace store into a dataframe.
+    """
+    _, meta_name = store_file_names(prefix)
+    with open(meta_name, "r") as f:
+        sidecar = json.load(f)
+
+    return pd.DataFrame(sidecar["columns"])
+
+
+
+class TraceStore():
+    """
+    Definition
+        Read access to a trace store. The trace matrix is memory mapped, so
+        opening it is instant and reading a row or a block of rows only
+        touches the corresponding part of the file.
+        The column range of every protocol (Action Potential, Inactivation,
+        ...) is known, so any selection of protocols can be read as views
+        of the matrix, without fetching or concatenating again.
+
+    Args:
+        prefix (str): prefix of the store files, e.g. "Na_family"
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        trace_name, meta_name = store_file_names(prefix)
+
+        with open(meta_name, "r") as f:
+            self.sidecar = json.load(f)
+        self.meta = pd.DataFrame(self.sidecar["columns"])
+        self.traces = np.load(trace_name, mmap_mode="r")
+
+        if (self.traces.shape[0] != len(self.meta)):
+            raise ValueError("[!] Trace store {} is inconsistent: {} traces \
+            but {} metadata rows!".format(prefix, self.traces.shape[0],
+                                            len(self.meta)))
+
+    def __len__(self):
+        return self.traces.shape[0]
+
+    @property
+    def n_trace_values(self):
+        return self.traces.shape[1]
+
+    @property
+    def protocols(self):
+        """
+        Returns the names of the stored protocols, in column order.
+        """
+        return [name for name, _, _ in self.sidecar.get("protocols", [])]
+
+    def protocol_range(self, name):
+        """
+        Returns the (start, stop) column range of a protocol.
+        """
+        for protocol, start, stop in self.sidecar.get("protocols", []):
+            if (protocol == name):
+                return start, stop
+        raise KeyError("[!] Protocol {} is not in trace store {}, it has {}!" \
+                        .format(name, self.prefix, self.protocols))
+
+    def protocol(self, name):
+        """
+        Returns the (n_channels x protocol length) view of one protocol.
+        """
+        start, stop = self.protocol_range(name)
+        return self.traces[:, start:stop]
+
+    def select(self, protocols=None):
+        """
+        Definition
+            Returns the traces of the given protocols, concatenated in column
+            order of the store. If the protocols are adjacent in the store,
+            this is a zero-copy view, otherwise the column ranges get copied
+            into a new array. None selects all protocols, a protocol given
+            more than once is selected once.
+        """
+        if (protocols is None):
+            return self.traces
+        if (len(protocols) == 0):
+            raise ValueError("[!] No protocols selected from trace store {}!" \
+                                .format(self.prefix))
+
+        ranges = sorted(set(self.protocol_range(name) for name in protocols))
+        # merge adjacent ranges, so e.g. Inactivation+Activation is one slice
+        merged = [list(ranges[0])]
+        for start, stop in ranges[1:]:
+            if (start == merged[-1][1]):
+                merged[-1][1] = stop
+            else:
+                merged.append([start, stop])
+
+        if (len(merged) == 1):
+            return self.traces[:, merged[0][0]:merged[0][1]]
+        return np.hstack([self.traces[:, start:stop] for start, stop in merged])
+
+    def trace_dict(self, row):
+        """
+        Returns the traces of a row in a dictionary protocol:view, e.g. for
+        trace_plotter_complete.
+        """
+        return {name: self.traces[row, start:stop] for name, start, stop in \
+                self.sidecar.get("protocols", [])}
+
+    def trace(self, row):
+        """
+        Returns the trace of a row as a read only view.
+        """
+        return self.traces[row]
+
+    def block(self, start, stop):
+        """
+        Returns the traces of rows start to stop as a read only view.
+        """
+        return self.traces[start:stop]
+
+    def iter_blocks(self, chunk_size=1024):
+        """
+        Yields (start, block) pairs of at most chunk_size rows.
+        """
+        for start in range(0, len(self), chunk_size):
+            yield start, self.traces[start:start + chunk_size]
+
+    def to_dataframe(self, protocols=None):
+        """
+        Returns the family dataframe in the layout of assemble_family_frame,
+        with each Conc_Trace entry being a view into the memory map (see
+        select for the protocols).
+        """
+        df = self.meta.copy()
+        df.insert(df.columns.get_loc('Family') + 1, 'Conc_Trace',
+                    list(self.select(protocols)))
+        return df
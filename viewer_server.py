@@ -0,0 +1,480 @@
+import argparse
+import json
+import re
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+from matplotlib.colors import to_hex
+from scipy.spatial import cKDTree
+
+from trace_store import load_metadata
+from point_labels import LabelRenderer
+from clustering import cluster_palette
+
+# bits per axis of the quantized coordinates, i.e. the deepest zoom level
+MAX_LEVEL = 16
+# an aggregated tile is split into 2**AGGREGATE_DEPTH cells per axis
+AGGREGATE_DEPTH = 6
+
+
+
+def spread_bits(values):
+    """
+    Spreads the lower 16 bits of every value apart, bit i going to bit 2i.
+    """
+    values = values.astype(np.uint64) & np.uint64(0xFFFF)
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333),
+                        (1, 0x55555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+
+def compact_bits(values):
+    """
+    Inverse of spread_bits: collects every second bit.
+    """
+    values = values.astype(np.uint64) & np.uint64(0x55555555)
+    for shift, mask in ((1, 0x33333333), (2, 0x0F0F0F0F), (4, 0x00FF00FF),
+                        (8, 0x0000FFFF)):
+        values = (values | (values >> np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+
+def morton_codes(column, row):
+    """
+    Interleaves the bits of two integer coordinates (Z-order curve), so that
+    the points of any quadtree tile are a contiguous range of sorted codes.
+    """
+    return spread_bits(column) | (spread_bits(row) << np.uint64(1))
+
+
+
+class TileIndex():
+    """
+    Definition
+        Quadtree tiling of the 2-D map. The coordinates are quantized to
+        2**MAX_LEVEL steps per axis and the points sorted by their Morton
+        code: the points of tile (zoom, x, y) then form one contiguous range,
+        found by binary search, so a tile costs O(log N + points in tile).
+        A tile with more than max_points points is served as aggregates
+        instead: the counts (and most common cluster) of a grid of
+        2**AGGREGATE_DEPTH x 2**AGGREGATE_DEPTH cells. The cells of every
+        zoom level are precomputed in one linear pass over the sorted codes
+        and are, again, contiguous per tile. So every response is bounded in
+        size and time, whatever the number of channels.
+        Tile (0, 0, 0) is the square around all points, tile x grows to the
+        right and tile y upwards, like the data coordinates.
+
+    Args:
+        x, y (np.ndarray): coordinates of the points (Value1, Value2)
+        clusters (np.ndarray): cluster of every point
+        max_points (int): most points a tile is served with
+    """
+
+    def __init__(self, x, y, clusters, max_points=2000):
+        self.max_points = max_points
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        clusters = np.asarray(clusters, dtype=np.int64)
+        self.n_clusters = int(clusters.max()) + 1 if len(clusters) else 0
+
+        # square world around the points
+        self.origin = np.array([x.min(), y.min()]) if len(x) else np.zeros(2)
+        self.size = max(np.ptp(x) if len(x) else 0.,
+                        np.ptp(y) if len(y) else 0.) * (1 + 1e-9) or 1.
+        steps = 2**MAX_LEVEL
+        column = ((x - self.origin[0]) / self.size * steps).astype(np.int64)
+        row = ((y - self.origin[1]) / self.size * steps).astype(np.int64)
+        codes = morton_codes(np.clip(column, 0, steps - 1),
+                                np.clip(row, 0, steps - 1))
+
+        self.order = np.argsort(codes, kind="stable")
+        self.codes = codes[self.order]
+        self.x = x[self.order]
+        self.y = y[self.order]
+        self.clusters = clusters[self.order]
+        self.tree = cKDTree(np.column_stack([x, y]))
+
+        # cells of the aggregated levels, as long as tiles can be too full
+        self.levels = {}
+        for zoom in range(MAX_LEVEL - AGGREGATE_DEPTH + 1):
+            if (self.max_tile_count(zoom) <= max_points):
+                break
+            self.levels[zoom] = self.aggregate(zoom + AGGREGATE_DEPTH)
+        self.max_zoom = MAX_LEVEL
+
+    def max_tile_count(self, zoom):
+        """
+        Returns the number of points in the fullest tile of a zoom level.
+        """
+        if (not len(self.codes)):
+            return 0
+        tiles = self.codes >> np.uint64(2*(MAX_LEVEL - zoom))
+        starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]])
+        return int(np.diff(np.r_[starts, len(tiles)]).max())
+
+    def aggregate(self, depth):
+        """
+        Returns (cell codes, counts, most common cluster) of all non empty
+        cells at the given depth, sorted by cell code.
+        """
+        cells = self.codes >> np.uint64(2*(MAX_LEVEL - depth))
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        cell_of_point = np.cumsum(np.r_[False, cells[1:] != cells[:-1]])
+        counts = np.diff(np.r_[starts, len(cells)])
+        per_cluster = np.bincount(cell_of_point * self.n_clusters + \
+                                    self.clusters,
+                                    minlength=len(starts)*self.n_clusters)
+        majority = per_cluster.reshape(len(starts), self.n_clusters) \
+                    .argmax(axis=1)
+        return cells[starts], counts, majority
+
+    def code_range(self, codes, zoom, tile_x, tile_y, depth):
+        """
+        Returns the slice of sorted codes at the given depth which lie in a
+        tile.
+        """
+        prefix = int(morton_codes(np.array([tile_x]), np.array([tile_y]))[0])
+        shift = 2*(depth - zoom)
+        start, stop = np.searchsorted(codes, [prefix << shift,
+                                                (prefix + 1) << shift])
+        return slice(start, stop)
+
+    def tile(self, zoom, tile_x, tile_y):
+        """
+        Definition
+            Returns the content of a tile as a json-able dictionary, either
+            {"points": [[x, y, cluster, row], ...]} or, for a tile with more
+            than max_points points, {"cells": [[x, y, size, count,
+            cluster], ...]} with (x, y) the lower left corner of a cell.
+            Rows refer to the plot values (and metadata) rows.
+        """
+        if (not 0 <= zoom <= self.max_zoom or \
+                not 0 <= tile_x < 2**zoom or not 0 <= tile_y < 2**zoom):
+            raise KeyError("[!] No tile {}/{}/{}!".format(zoom, tile_x,
+                                                            tile_y))
+        points = self.code_range(self.codes, zoom, tile_x, tile_y, MAX_LEVEL)
+        n_points = points.stop - points.start
+        if (zoom not in self.levels and n_points > self.max_points):
+            # too many points on the same spot of the deepest levels, an
+            # evenly spread subset of them is shown
+            points = slice(points.start, points.stop,
+                            -(-n_points // self.max_points))
+        if (n_points <= self.max_points or zoom not in self.levels):
+            return {"points": np.column_stack([self.x[points],
+                                                self.y[points],
+                                                self.clusters[points],
+                                                self.order[points]]).tolist()}
+
+        cell_codes, counts, majority = self.levels[zoom]
+        depth = zoom + AGGREGATE_DEPTH
+        cells = self.code_range(cell_codes, zoom, tile_x, tile_y, depth)
+        cell_size = self.size / 2**depth
+        cell_x = compact_bits(cell_codes[cells]) * cell_size + self.origin[0]
+        cell_y = compact_bits(cell_codes[cells] >> np.uint64(1)) * cell_size \
+                    + self.origin[1]
+        return {"cells": np.column_stack([cell_x, cell_y,
+                                            np.full(len(cell_x), cell_size),
+                                            counts[cells],
+                                            majority[cells]]).tolist()}
+
+    def nearest(self, x, y, radius=np.inf):
+        """
+        Returns the row of the point closest to (x, y), None if there is no
+        point within radius.
+        """
+        distance, row = self.tree.query([x, y], distance_upper_bound=radius)
+        return None if np.isinf(distance) else int(row)
+
+
+
+class MapViewer():
+    """
+    Definition
+        Everything the viewer server answers from: the tile index of the
+        plot values, the metadata of every point (only the sidecar of the
+        trace store is read, not the traces) and the labels, rendered on
+        demand. Tiles are encoded once and kept in an LRU cache.
+
+    Args:
+        plot_file (str): pickle of the plot values (Value1, Value2, Cluster)
+        meta_name (str): prefix of the trace store, e.g. "Na_family"
+        max_points (int): most points a tile is served with
+        cache_size (int): number of encoded tiles kept
+    """
+
+    def __init__(self, plot_file, meta_name, max_points=2000, cache_size=4096):
+        df = pd.read_pickle(plot_file)
+        self.meta_df = load_metadata(meta_name)
+        if (len(df) != len(self.meta_df)):
+            raise ValueError("[!] {} has {} points, but {} has {} metadata \
+            rows!".format(plot_file, len(df), meta_name, len(self.meta_df)))
+
+        self.index = TileIndex(df['Value1'].to_numpy(),
+                                df['Value2'].to_numpy(),
+                                df['Cluster'].to_numpy(), max_points)
+        self.labels = LabelRenderer(self.meta_df)
+        self.encoded_tile = lru_cache(maxsize=cache_size)(self._encode_tile)
+
+    def _encode_tile(self, zoom, tile_x, tile_y):
+        return json.dumps(self.index.tile(zoom, tile_x, tile_y)) \
+                .encode("utf8")
+
+    def info(self):
+        return {"n_points": len(self.meta_df),
+                "origin": self.index.origin.tolist(),
+                "size": self.index.size,
+                "max_zoom": self.index.max_zoom,
+                "max_points": self.index.max_points,
+                "palette": [to_hex(color) for color in \
+                            cluster_palette(self.index.n_clusters)]}
+
+    def metadata(self, row):
+        if (not 0 <= row < len(self.meta_df)):
+            raise KeyError("[!] No datapoint {}!".format(row))
+        values = self.meta_df.iloc[row]
+        return {"row": row,
+                "metadata": json.loads(values.to_json(default_handler=str)),
+                "label": self.labels(row)}
+
+
+
+def make_handler(viewer):
+    """
+    Returns the request handler class of the viewer server:
+        /                       the viewer page
+        /info                   extent, zoom levels and cluster colors
+        /tiles/<z>/<x>/<y>      content of a tile, see TileIndex.tile
+        /nearest?x=&y=&radius=  row of the point closest to a click
+        /meta/<row>             metadata and label of a datapoint
+    """
+
+    class ViewerHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, status=200,
+                        content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data, status=200):
+            self.send_body(json.dumps(data).encode("utf8"), status)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in \
+                        parse_qs(url.query).items()}
+            try:
+                tile = re.fullmatch(r"/tiles/(\d+)/(\d+)/(\d+)", url.path)
+                meta = re.fullmatch(r"/meta/(\d+)", url.path)
+                if (url.path == "/"):
+                    self.send_body(VIEWER_PAGE.encode("utf8"),
+                                    content_type="text/html; charset=utf-8")
+                elif (url.path == "/info"):
+                    self.send_json(viewer.info())
+                elif (tile):
+                    self.send_body(viewer.encoded_tile(*map(int,
+                                                            tile.groups())))
+                elif (url.path == "/nearest"):
+                    self.send_json({"row": viewer.index.nearest(
+                                    float(query["x"]), float(query["y"]),
+                                    float(query.get("radius", "inf")))})
+                elif (meta):
+                    self.send_json(viewer.metadata(int(meta.group(1))))
+                else:
+                    self.send_json({"error": "not found"}, 404)
+            except (KeyError, ValueError) as error:
+                self.send_json({"error": str(error)}, 404)
+
+    return ViewerHandler
+
+
+
+# single page client: draws the tiles visible at the current zoom on a
+# canvas, fetching each tile once; a click asks for the nearest point and
+# then for its metadata
+VIEWER_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>CGI Channels</title>
+<style>
+body { margin: 0; font-family: sans-serif; overflow: hidden; }
+canvas { display: block; cursor: crosshair; }
+#panel { position: absolute; top: 8px; right: 8px; max-width: 40%;
+         max-height: 90%; overflow: auto; background: rgba(255,255,255,.92);
+         border: 1px solid #888; padding: 6px; font-size: 12px; }
+#panel pre { margin: 0; }
+#status { position: absolute; bottom: 4px; left: 8px; font-size: 12px; }
+</style></head>
+<body><canvas id="map"></canvas><div id="panel">Click on a point</div>
+<div id="status"></div>
+<script>
+const canvas = document.getElementById("map");
+const ctx = canvas.getContext("2d");
+const tiles = new Map();
+let info = null;
+// view: world point in the canvas center and pixels per world unit, the
+// world being the unit square of tile 0/0/0
+let view = {cx: 0.5, cy: 0.5, scale: 1};
+
+function resize() {
+    canvas.width = window.innerWidth;
+    canvas.height = window.innerHeight;
+    draw();
+}
+
+function zoomLevel() {
+    return Math.max(0, Math.min(info.max_zoom,
+                    Math.floor(Math.log2(view.scale / 256))));
+}
+
+function toScreen(u, v) {
+    return [(u - view.cx) * view.scale + canvas.width / 2,
+            canvas.height / 2 - (v - view.cy) * view.scale];
+}
+
+function toWorld(px, py) {
+    return [view.cx + (px - canvas.width / 2) / view.scale,
+            view.cy - (py - canvas.height / 2) / view.scale];
+}
+
+function visibleTiles() {
+    const z = zoomLevel(), n = 2 ** z;
+    const [u0, v1] = toWorld(0, 0);
+    const [u1, v0] = toWorld(canvas.width, canvas.height);
+    const clamp = t => Math.max(0, Math.min(n - 1, Math.floor(t * n)));
+    const result = [];
+    for (let x = clamp(u0); x <= clamp(u1); x++)
+        for (let y = clamp(v0); y <= clamp(v1); y++)
+            result.push(z + "/" + x + "/" + y);
+    return result;
+}
+
+function draw() {
+    if (!info) return;
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    const wanted = visibleTiles();
+    let shown = 0;
+    for (const key of wanted) {
+        const tile = tiles.get(key);
+        if (tile === undefined) {
+            tiles.set(key, null);
+            fetch("/tiles/" + key).then(r => r.json()).then(data => {
+                tiles.set(key, data);
+                draw();
+            });
+            continue;
+        }
+        if (tile === null) continue;
+        if (tile.points) {
+            for (const [x, y, cluster] of tile.points) {
+                const [px, py] = toScreen((x - info.origin[0]) / info.size,
+                                            (y - info.origin[1]) / info.size);
+                ctx.fillStyle = info.palette[cluster];
+                ctx.fillRect(px - 2, py - 2, 4, 4);
+            }
+            shown += tile.points.length;
+        } else {
+            for (const [x, y, size, count, cluster] of tile.cells) {
+                const [px, py] = toScreen((x - info.origin[0]) / info.size,
+                                    (y + size - info.origin[1]) / info.size);
+                const side = Math.max(1, size / info.size * view.scale);
+                ctx.globalAlpha = Math.min(1, 0.3 + Math.log10(count) / 3);
+                ctx.fillStyle = info.palette[cluster];
+                ctx.fillRect(px, py, side, side);
+                shown += count;
+            }
+            ctx.globalAlpha = 1;
+        }
+    }
+    document.getElementById("status").textContent = "zoom " + zoomLevel() +
+        ", " + wanted.length + " tiles, " + shown + " of " + info.n_points +
+        " channels";
+}
+
+let drag = null;
+canvas.addEventListener("mousedown", e => {
+    drag = {x: e.clientX, y: e.clientY, moved: false};
+});
+canvas.addEventListener("mousemove", e => {
+    if (!drag) return;
+    const dx = e.clientX - drag.x, dy = e.clientY - drag.y;
+    if (Math.abs(dx) + Math.abs(dy) > 2) drag.moved = true;
+    view.cx -= dx / view.scale;
+    view.cy += dy / view.scale;
+    drag.x = e.clientX;
+    drag.y = e.clientY;
+    draw();
+});
+canvas.addEventListener("mouseup", e => {
+    if (drag && !drag.moved) showPoint(e.clientX, e.clientY);
+    drag = null;
+});
+canvas.addEventListener("wheel", e => {
+    e.preventDefault();
+    const [u, v] = toWorld(e.clientX, e.clientY);
+    const factor = e.deltaY < 0 ? 1.25 : 0.8;
+    view.scale *= factor;
+    // keep the world point under the cursor in place
+    view.cx = u - (u - view.cx) / factor;
+    view.cy = v - (v - view.cy) / factor;
+    draw();
+}, {passive: false});
+
+function showPoint(px, py) {
+    const [u, v] = toWorld(px, py);
+    const x = info.origin[0] + u * info.size;
+    const y = info.origin[1] + v * info.size;
+    const radius = 6 / view.scale * info.size;
+    fetch("/nearest?x=" + x + "&y=" + y + "&radius=" + radius)
+        .then(r => r.json()).then(data => {
+            if (data.row === null) return;
+            fetch("/meta/" + data.row).then(r => r.json()).then(meta => {
+                const pre = document.createElement("pre");
+                pre.textContent = meta.label;
+                const panel = document.getElementById("panel");
+                panel.replaceChildren(pre);
+            });
+        });
+}
+
+fetch("/info").then(r => r.json()).then(data => {
+    info = data;
+    view.scale = Math.min(window.innerWidth, window.innerHeight) * 0.9;
+    resize();
+});
+window.addEventListener("resize", resize);
+</script></body></html>
+"""
+
+
+
+if (__name__=="__main__"):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("plot_file", nargs="?",
+                        default="Interactive_Plot_Values.pickle")
+    parser.add_argument("meta_name", nargs="?", default="Na_family",
+                        help="prefix of the trace store")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--max-points", type=int, default=2000,
+                        help="most points served per tile")
+    args = parser.parse_args()
+
+    viewer = MapViewer(args.plot_file, args.meta_name,
+                        max_points=args.max_points)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                    make_handler(viewer))
+    server.daemon_threads = True
+    print("[+] Serving {} channels on http://127.0.0.1:{}/".format(
+            viewer.info()["n_points"], args.port))
+    server.serve_forever()